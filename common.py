@@ -4,46 +4,288 @@ import os
 import sys
 import re
 import time
-import tempfile
-import json
 import datetime
-import subprocess
+import struct
+import fcntl
+import select
+import math
+import marshal
+import threading
+import collections
+import queue
+import atexit
+import json
+import socket
+import hashlib
+import sqlite3
+
+###############################################################################
+#	get_tempdir
+###############################################################################
+def get_tempdir():
+	# tempfile.gettempdir() without importing tempfile
+	for name in ['TMPDIR', 'TEMP', 'TMP']:
+		if os.environ.get(name):
+			return os.environ[name]
+	return '/tmp'
 
 ###############################################################################
 #	read_str_from_file
 ###############################################################################
 def read_str_from_file(filename):
-	f = open(filename, 'r')
-	ret = f.readline()
+	with open(filename, 'r') as f:
+		ret = f.readline()
 	while len(ret) > 0 and (ret[-1] == '\r' or ret[-1] == '\n'):
 		ret = ret[:-1]
-	f.close
 	return ret
 	
 ###############################################################################
 #	read_int_from_file
 ###############################################################################
 def read_int_from_file(filename):
-	f = open(filename, 'r')
-	ret = int(f.readline())
-	f.close
-	return ret
+	with open(filename, 'r') as f:
+		return int(f.readline())
 	
 ###############################################################################
 #	write_str_to_file
 ###############################################################################
 def write_str_to_file(filename, value):
-	f = open(filename, 'w')
-	f.write(value)
-	f.close
+	with open(filename, 'w') as f:
+		f.write(value)
 
 ###############################################################################
 #	write_int_to_file
 ###############################################################################
 def write_int_to_file(filename, value):
-	f = open(filename, 'w')
-	f.write(str(value))
-	f.close
+	with open(filename, 'w') as f:
+		f.write(str(value))
+
+###############################################################################
+#	class Sysfs
+###############################################################################
+class Sysfs:
+	# attribute files kept open and re-read with pread at offset 0
+	max_open = 64
+	fds = collections.OrderedDict()
+	buf = bytearray(4096)
+	lock = threading.Lock()
+
+	def get_fd(filename, flags):
+		key = (filename, flags)
+		fd = Sysfs.fds.get(key)
+		if fd != None:
+			Sysfs.fds.move_to_end(key)
+			return fd
+		fd = os.open(filename, flags)
+		Sysfs.fds[key] = fd
+		if len(Sysfs.fds) > Sysfs.max_open:
+			key, old = Sysfs.fds.popitem(last=False)
+			os.close(old)
+		return fd
+
+	def read(filename):
+		# returns the length of the value in Sysfs.buf, lock held by the caller
+		n = os.preadv(Sysfs.get_fd(filename, os.O_RDONLY), [Sysfs.buf], 0)
+		while n > 0 and Sysfs.buf[n - 1] in b'\r\n':
+			n -= 1
+		return n
+
+	def read_str(filename):
+		with Sysfs.lock:
+			n = Sysfs.read(filename)
+			return Sysfs.buf[:n].decode('utf-8').split('\n', 1)[0]
+
+	def read_int(filename):
+		with Sysfs.lock:
+			n = Sysfs.read(filename)
+			v = 0
+			sign = 1
+			digits = 0
+			for i in range(n):
+				c = Sysfs.buf[i]
+				if c == 0x2d and i == 0:
+					sign = -1
+				elif 0x30 <= c <= 0x39:
+					v = v * 10 + c - 0x30
+					digits += 1
+				elif c in b' \t':
+					break
+				else:
+					raise ValueError('invalid integer in %s' % filename)
+			# empty or a lone '-' is not a level 0
+			if digits == 0:
+				raise ValueError('invalid integer in %s' % filename)
+			return sign * v
+
+	def write_str(filename, value):
+		with Sysfs.lock:
+			os.pwrite(Sysfs.get_fd(filename, os.O_WRONLY), value.encode('utf-8'), 0)
+
+	def write_int(filename, value):
+		Sysfs.write_str(filename, str(value))
+
+	def forget(prefix):
+		# attributes of a removed directory, e.g. an unexported gpio
+		with Sysfs.lock:
+			for key in [k for k in Sysfs.fds if k[0].startswith(prefix)]:
+				os.close(Sysfs.fds.pop(key))
+
+	def close():
+		with Sysfs.lock:
+			while len(Sysfs.fds) > 0:
+				key, fd = Sysfs.fds.popitem()
+				os.close(fd)
+
+atexit.register(Sysfs.close)
+
+###############################################################################
+#	load_cached
+###############################################################################
+file_cache = dict()
+
+def load_cached(filename, loader):
+	st = os.stat(filename)
+	key = (st.st_mtime_ns, st.st_size)
+	entry = file_cache.get(filename)
+	if entry == None or entry[0] != key:
+		entry = (key, loader(filename))
+		file_cache[filename] = entry
+	return entry[1]
+
+###############################################################################
+#	load_json
+###############################################################################
+def load_json(filename):
+	with open(filename) as f:
+		return json.load(f)
+
+###############################################################################
+#	load_json_precompiled
+###############################################################################
+def load_json_precompiled(filename):
+	# marshal copy in __pycache__, valid while mtime and size match
+	st = os.stat(filename)
+	key = (st.st_mtime_ns, st.st_size)
+	directory = os.path.join(os.path.dirname(filename), '__pycache__')
+	path = os.path.join(directory, os.path.basename(filename) + '.marshal')
+	try:
+		with open(path, 'rb') as f:
+			cached_key, value = marshal.load(f)
+		if cached_key == key:
+			return value
+	except (OSError, EOFError, ValueError, TypeError):
+		pass
+	value = load_json(filename)
+	try:
+		os.makedirs(directory, exist_ok=True)
+		tmp = '%s.%d' % (path, os.getpid())
+		with open(tmp, 'wb') as f:
+			marshal.dump((key, value), f)
+		os.replace(tmp, path)
+	except OSError:
+		pass
+	return value
+
+###############################################################################
+#	class Gpio_chip
+###############################################################################
+class Gpio_chip:
+	# GPIO v2 character device uAPI, linux/gpio.h
+	GPIO_V2_GET_LINE_IOCTL = 0xC250B407
+	GPIO_V2_LINE_GET_VALUES_IOCTL = 0xC010B40E
+	GPIO_V2_LINE_SET_VALUES_IOCTL = 0xC010B40F
+	FLAG_INPUT = 0x04
+	FLAG_OUTPUT = 0x08
+	FLAG_EDGE_RISING = 0x10
+	FLAG_EDGE_FALLING = 0x20
+	ATTR_ID_FLAGS = 1
+	ATTR_ID_OUTPUT_VALUES = 2
+	MAX_ATTRS = 10
+	EVENT_RISING_EDGE = 1
+	EVENT_SIZE = 48
+
+	def __init__(self, path, consumer='gt5-test'):
+		self.path = path
+		self.consumer = consumer
+		self.flags = dict()
+		self.values = dict()
+		self.offsets = []
+		self.fd = None
+		self.lock = threading.Lock()
+
+	def release(self):
+		if self.fd != None:
+			os.close(self.fd)
+			self.fd = None
+
+	def request(self):
+		# all lines of the chip in one request, so they are read with one ioctl
+		with self.lock:
+			self.release()
+			self.offsets = sorted(self.flags)
+			if len(self.offsets) == 0:
+				return
+			groups = dict()
+			outputs = 0
+			values = 0
+			for i in range(len(self.offsets)):
+				o = self.offsets[i]
+				if self.flags[o] != Gpio_chip.FLAG_INPUT:
+					groups[self.flags[o]] = groups.get(self.flags[o], 0) | (1 << i)
+				if self.flags[o] & Gpio_chip.FLAG_OUTPUT:
+					outputs |= 1 << i
+					if self.values.get(o, 0):
+						values |= 1 << i
+			attrs = [(Gpio_chip.ATTR_ID_FLAGS, flags, mask) for flags, mask in groups.items()]
+			if outputs:
+				attrs.append((Gpio_chip.ATTR_ID_OUTPUT_VALUES, values, outputs))
+			if len(attrs) > Gpio_chip.MAX_ATTRS:
+				raise ValueError('too many line configurations on %s' % self.path)
+			# struct gpio_v2_line_request, 592 bytes
+			req = bytearray(592)
+			struct.pack_into('64I', req, 0, *(self.offsets + [0] * (64 - len(self.offsets))))
+			struct.pack_into('32s', req, 256, self.consumer.encode('utf-8'))
+			struct.pack_into('QI', req, 288, Gpio_chip.FLAG_INPUT, len(attrs))
+			for k in range(len(attrs)):
+				struct.pack_into('IIQQ', req, 320 + 24 * k, attrs[k][0], 0, attrs[k][1], attrs[k][2])
+			struct.pack_into('I', req, 560, len(self.offsets))
+			chip = os.open(self.path, os.O_RDONLY)
+			try:
+				fcntl.ioctl(chip, Gpio_chip.GPIO_V2_GET_LINE_IOCTL, req)
+			finally:
+				os.close(chip)
+			self.fd = struct.unpack_from('i', req, 588)[0]
+
+	def mask(self, offsets):
+		m = 0
+		for o in offsets:
+			m |= 1 << self.offsets.index(o)
+		return m
+
+	def get_values(self, offsets):
+		with self.lock:
+			data = bytearray(struct.pack('QQ', 0, self.mask(offsets)))
+			fcntl.ioctl(self.fd, Gpio_chip.GPIO_V2_LINE_GET_VALUES_IOCTL, data)
+		bits = struct.unpack('QQ', data)[0]
+		return dict([(o, (bits >> self.offsets.index(o)) & 1) for o in offsets])
+
+	def set_value(self, offset, v):
+		self.values[offset] = v
+		with self.lock:
+			m = self.mask([offset])
+			fcntl.ioctl(self.fd, Gpio_chip.GPIO_V2_LINE_SET_VALUES_IOCTL, struct.pack('QQ', m if v else 0, m))
+
+	def read_events(self, timeout):
+		# kernel timestamps, CLOCK_MONOTONIC in ns
+		readable, writable, exceptional = select.select([self.fd], [], [], max(timeout, 0))
+		if len(readable) == 0:
+			return []
+		data = os.read(self.fd, Gpio_chip.EVENT_SIZE * 64)
+		events = []
+		for k in range(0, len(data), Gpio_chip.EVENT_SIZE):
+			ts, event_id, offset = struct.unpack_from('QII', data, k)
+			events.append((ts, offset, event_id == Gpio_chip.EVENT_RISING_EDGE))
+		return events
 
 ###############################################################################
 #	class Gpio
@@ -52,28 +294,1267 @@ class Gpio:
 	gpio_table = {
 		'IN_FAN_FB': 72
 	}
+	# 'sysfs' (/sys/class/gpio) or 'cdev' (/dev/gpiochipN)
+	backend = 'sysfs'
+	# name -> (chip device, offset) for the cdev backend, default from the sysfs base
+	line_table = dict()
+	chips = dict()
+
+	def configure(config):
+		Gpio.backend = config['backend']
+		for name in config['lines']:
+			Gpio.line_table[name] = tuple(config['lines'][name])
+
+	def locate(name):
+		if name not in Gpio.line_table:
+			i = Gpio.gpio_table[name]
+			for d in os.listdir('/sys/class/gpio'):
+				if not d.startswith('gpiochip'):
+					continue
+				base = read_int_from_file('/sys/class/gpio/%s/base' % d)
+				if base <= i < base + read_int_from_file('/sys/class/gpio/%s/ngpio' % d):
+					devices = [c for c in os.listdir('/sys/class/gpio/%s/device' % d) if c.startswith('gpiochip')]
+					Gpio.line_table[name] = ('/dev/' + devices[0], i - base)
+					break
+			else:
+				raise OSError('no gpiochip for gpio %d' % i)
+		path, offset = Gpio.line_table[name]
+		if path not in Gpio.chips:
+			Gpio.chips[path] = Gpio_chip(path)
+		return Gpio.chips[path], offset
+
+	def is_exported(name):
+		if Gpio.backend == 'cdev':
+			chip, offset = Gpio.locate(name)
+			return offset in chip.flags
+		return os.path.exists('/sys/class/gpio/gpio%d' % Gpio.gpio_table[name])
 
 	def export(name):
+		if Gpio.backend == 'cdev':
+			chip, offset = Gpio.locate(name)
+			if offset not in chip.flags:
+				chip.flags[offset] = Gpio_chip.FLAG_INPUT
+				chip.request()
+			return
 		i = Gpio.gpio_table[name]
 		if not os.path.exists('/sys/class/gpio/gpio%d' % i):
-			write_int_to_file('/sys/class/gpio/export', i)
+			Sysfs.write_int('/sys/class/gpio/export', i)
 
 	def unexport(name):
+		if Gpio.backend == 'cdev':
+			chip, offset = Gpio.locate(name)
+			if offset in chip.flags:
+				del chip.flags[offset]
+				chip.request()
+			return
 		i = Gpio.gpio_table[name]
+		Sysfs.forget('/sys/class/gpio/gpio%d/' % i)
 		if os.path.exists('/sys/class/gpio/gpio%d' % i):
-			write_int_to_file('/sys/class/gpio/unexport', i)
+			Sysfs.write_int('/sys/class/gpio/unexport', i)
 
 	def set_direction(name, d):
+		if Gpio.backend == 'cdev':
+			chip, offset = Gpio.locate(name)
+			# same values as the sysfs direction file
+			if d == 'in':
+				chip.flags[offset] = Gpio_chip.FLAG_INPUT
+			else:
+				chip.flags[offset] = Gpio_chip.FLAG_OUTPUT
+				chip.values[offset] = 1 if d == 'high' else 0
+			chip.request()
+			return
+		i = Gpio.gpio_table[name]
+		Sysfs.write_str('/sys/class/gpio/gpio%d/direction' % i, d)
+
+	def set_edge(name, edge):
+		if Gpio.backend == 'cdev':
+			chip, offset = Gpio.locate(name)
+			flags = { 'none': 0, 'rising': Gpio_chip.FLAG_EDGE_RISING, 'falling': Gpio_chip.FLAG_EDGE_FALLING, 'both': Gpio_chip.FLAG_EDGE_RISING | Gpio_chip.FLAG_EDGE_FALLING }
+			chip.flags[offset] = Gpio_chip.FLAG_INPUT | flags[edge]
+			chip.request()
+			return
 		i = Gpio.gpio_table[name]
-		write_str_to_file('/sys/class/gpio/gpio%d/direction' % i, d)
+		Sysfs.write_str('/sys/class/gpio/gpio%d/edge' % i, edge)
 
 	def read(name):
+		if Gpio.backend == 'cdev':
+			chip, offset = Gpio.locate(name)
+			return chip.get_values([offset])[offset]
 		i = Gpio.gpio_table[name]
-		return read_int_from_file('/sys/class/gpio/gpio%d/value' % i)
+		return Sysfs.read_int('/sys/class/gpio/gpio%d/value' % i)
+
+	def read_bulk(names):
+		if Gpio.backend != 'cdev':
+			return dict([(name, Gpio.read(name)) for name in names])
+		# one ioctl per chip
+		lines = dict()
+		for name in names:
+			chip, offset = Gpio.locate(name)
+			lines.setdefault(chip, []).append((name, offset))
+		values = dict()
+		for chip in lines:
+			v = chip.get_values([offset for name, offset in lines[chip]])
+			for name, offset in lines[chip]:
+				values[name] = v[offset]
+		return values
 
 	def write(name, v):
+		if Gpio.backend == 'cdev':
+			chip, offset = Gpio.locate(name)
+			chip.set_value(offset, v)
+			return
 		i = Gpio.gpio_table[name]
-		write_int_to_file('/sys/class/gpio/gpio%d/value' % i, v)
+		Sysfs.write_int('/sys/class/gpio/gpio%d/value' % i, v)
+
+	def wait_edges(name, timeout):
+		# edges seen within timeout as (timestamp ns, rising), set_edge first
+		events = []
+		end = time.monotonic() + timeout
+		if Gpio.backend == 'cdev':
+			chip, offset = Gpio.locate(name)
+			while True:
+				remaining = end - time.monotonic()
+				if remaining <= 0:
+					return events
+				events += [(ts, rising) for ts, o, rising in chip.read_events(remaining) if o == offset]
+		# sysfs: POLLPRI on the value file, timestamped here
+		fd = os.open('/sys/class/gpio/gpio%d/value' % Gpio.gpio_table[name], os.O_RDONLY)
+		try:
+			poller = select.poll()
+			poller.register(fd, select.POLLPRI | select.POLLERR)
+			os.pread(fd, 8, 0)
+			while True:
+				remaining = end - time.monotonic()
+				if remaining <= 0:
+					return events
+				if len(poller.poll(remaining * 1000)) > 0:
+					ts = time.monotonic_ns()
+					events.append((ts, os.pread(fd, 8, 0)[:1] == b'1'))
+		finally:
+			os.close(fd)
+
+	def measure_frequency(name, window):
+		# rising edges over window seconds, returns (Hz, edges)
+		Gpio.set_edge(name, 'rising')
+		try:
+			edges = [ts for ts, rising in Gpio.wait_edges(name, window) if rising]
+		finally:
+			Gpio.set_edge(name, 'none')
+		if len(edges) < 2:
+			return 0.0, len(edges)
+		return (len(edges) - 1) * 1e9 / (edges[-1] - edges[0]), len(edges)
+
+###############################################################################
+#	class Inotify
+###############################################################################
+class Inotify:
+	IN_ATTRIB = 0x00000004
+	IN_MOVED_TO = 0x00000080
+	IN_CREATE = 0x00000100
+	IN_NONBLOCK = 0x00000800
+	IN_CLOEXEC = 0x00080000
+	libc = None
+
+	def __init__(self):
+		import ctypes
+		if Inotify.libc == None:
+			import ctypes.util
+			Inotify.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+		self.fd = Inotify.libc.inotify_init1(Inotify.IN_NONBLOCK | Inotify.IN_CLOEXEC)
+		if self.fd < 0:
+			e = ctypes.get_errno()
+			raise OSError(e, os.strerror(e))
+
+	def add_watch(self, path, mask):
+		wd = Inotify.libc.inotify_add_watch(self.fd, path.encode('utf-8'), mask)
+		if wd < 0:
+			import ctypes
+			e = ctypes.get_errno()
+			raise OSError(e, os.strerror(e), path)
+		return wd
+
+	def read(self):
+		names = []
+		try:
+			data = os.read(self.fd, 4096)
+		except BlockingIOError:
+			return names
+		i = 0
+		while i + 16 <= len(data):
+			wd, mask, cookie, length = struct.unpack_from('iIII', data, i)
+			names.append(data[i + 16:i + 16 + length].rstrip(b'\0').decode('utf-8', 'replace'))
+			i += 16 + length
+		return names
+
+	def close(self):
+		if self.fd >= 0:
+			os.close(self.fd)
+			self.fd = -1
+
+###############################################################################
+#	wait_for_path
+###############################################################################
+def wait_for_path(path, timeout):
+	start = time.perf_counter()
+	try:
+		inotify = Inotify()
+	except (OSError, AttributeError):
+		inotify = None
+	watched = set()
+	try:
+		while True:
+			if os.path.exists(path):
+				return time.perf_counter() - start
+			remaining = start + timeout - time.perf_counter()
+			if remaining <= 0:
+				return None
+			if inotify == None:
+				time.sleep(min(.1, remaining))
+				continue
+			# watch the deepest existing ancestor, it moves down as directories appear
+			parent = os.path.dirname(os.path.abspath(path))
+			while not os.path.isdir(parent):
+				parent = os.path.dirname(parent)
+			if parent not in watched:
+				inotify.add_watch(parent, Inotify.IN_CREATE | Inotify.IN_MOVED_TO | Inotify.IN_ATTRIB)
+				watched.add(parent)
+				continue
+			readable, writable, exceptional = select.select([inotify.fd], [], [], remaining)
+			if len(readable) > 0:
+				inotify.read()
+	finally:
+		if inotify != None:
+			inotify.close()
+
+###############################################################################
+#	class Uevent_listener
+###############################################################################
+class Uevent_listener:
+	NETLINK_KOBJECT_UEVENT = 15
+
+	def __init__(self):
+		self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, Uevent_listener.NETLINK_KOBJECT_UEVENT)
+		# multicast group 1: events sent by the kernel
+		self.sock.bind((0, 1))
+
+	def close(self):
+		self.sock.close()
+
+	def receive(self, timeout):
+		readable, writable, exceptional = select.select([self.sock], [], [], max(timeout, 0))
+		if len(readable) == 0:
+			return None
+		fields = self.sock.recv(8192).split(b'\0')
+		env = dict()
+		for f in fields[1:]:
+			k, sep, v = f.decode('utf-8', 'replace').partition('=')
+			if sep:
+				env[k] = v
+		return env
+
+	def wait(self, match, timeout):
+		start = time.perf_counter()
+		while True:
+			remaining = start + timeout - time.perf_counter()
+			if remaining <= 0:
+				return None
+			env = self.receive(remaining)
+			if env == None:
+				return None
+			for k in match:
+				if env.get(k) != match[k]:
+					break
+			else:
+				return env
+
+###############################################################################
+#	class Kmsg_record
+###############################################################################
+class Kmsg_record:
+	def __init__(self, seq, ts, name, text):
+		self.seq = seq
+		self.ts = ts
+		self.name = name
+		self.text = text
+
+###############################################################################
+#	class Kmsg_reader
+###############################################################################
+class Kmsg_reader:
+	def __init__(self, signatures, path='/dev/kmsg'):
+		# one pattern for all signatures, the group name tells which one matched
+		self.regex = re.compile('|'.join(['(?P<%s>%s)' % (name, signatures[name]) for name in signatures]))
+		self.fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+		self.seq = -1
+		self.matches = dict()
+
+	def close(self):
+		if self.fd != None:
+			os.close(self.fd)
+			self.fd = None
+
+	def scan(self):
+		# each read returns one record, the fd keeps its position between scans
+		while True:
+			try:
+				data = os.read(self.fd, 8192)
+			except BlockingIOError:
+				return self.matches
+			except BrokenPipeError:
+				# records overwritten in the ring buffer before we read them
+				continue
+			if not data:
+				return self.matches
+			header, sep, text = data.partition(b';')
+			fields = header.split(b',')
+			if not sep or len(fields) < 3:
+				continue
+			seq = int(fields[1])
+			if seq <= self.seq:
+				continue
+			self.seq = seq
+			text = text.split(b'\n', 1)[0].decode('utf-8', 'replace')
+			m = self.regex.search(text)
+			if m != None and m.lastgroup not in self.matches:
+				self.matches[m.lastgroup] = Kmsg_record(seq, int(fields[2]) / 1000000.0, m.lastgroup, text)
+
+	def wait(self, name, timeout):
+		# name None: any signature
+		start = time.perf_counter()
+		while True:
+			self.scan()
+			if name == None and len(self.matches) > 0:
+				return next(iter(self.matches.values()))
+			if name in self.matches:
+				return self.matches[name]
+			remaining = start + timeout - time.perf_counter()
+			if remaining <= 0:
+				return None
+			select.select([self.fd], [], [], remaining)
+
+###############################################################################
+#	find_usb_device
+###############################################################################
+def find_usb_device(vid, pid):
+	base = '/sys/bus/usb/devices'
+	if not os.path.isdir(base):
+		return []
+	devices = []
+	for d in os.listdir(base):
+		path = os.path.join(base, d)
+		try:
+			if read_str_from_file(os.path.join(path, 'idVendor')).lower() == vid and read_str_from_file(os.path.join(path, 'idProduct')).lower() == pid:
+				devices.append(path)
+		except OSError:
+			# interfaces have no idVendor/idProduct
+			pass
+	return devices
+
+###############################################################################
+#	find_hid_device
+###############################################################################
+def find_hid_device(vid, pid):
+	base = '/sys/bus/hid/devices'
+	if not os.path.isdir(base):
+		return []
+	# names are BUS:VID:PID.N, e.g. 0003:04D8:0C02.0001
+	suffix = ':%s:%s.' % (vid.upper(), pid.upper())
+	return [os.path.join(base, d) for d in os.listdir(base) if d[4:].upper().startswith(suffix)]
+
+###############################################################################
+#	find_device
+###############################################################################
+def find_device(vid, pid):
+	vid = vid.lower()
+	pid = pid.lower()
+	return find_usb_device(vid, pid) + find_hid_device(vid, pid)
+
+###############################################################################
+#	class Verify_result
+###############################################################################
+class Verify_result:
+	def __init__(self, directory):
+		self.directory = directory
+		self.files = 0
+		self.failed = []
+		self.nbytes = 0
+		self.elapsed = 0.0
+
+	def ok(self):
+		return self.files > 0 and len(self.failed) == 0
+
+	def mbps(self):
+		if self.elapsed <= 0:
+			return 0.0
+		return self.nbytes / self.elapsed / 1000000.0
+
+###############################################################################
+#	class Sha256_verifier
+###############################################################################
+class Sha256_verifier:
+	def __init__(self, bufsize=1024*1024):
+		self.buf = bytearray(bufsize)
+		self.view = memoryview(self.buf)
+
+	def parse_manifest(filename):
+		entries = []
+		with open(filename) as f:
+			for line in f:
+				line = line.rstrip('\r\n')
+				if len(line) == 0:
+					continue
+				digest, sep, name = line.partition(' ')
+				# sha256sum writes ' name' in text mode and '*name' in binary mode
+				entries.append((digest.lower(), name[1:]))
+		return entries
+
+	def hash_file(self, filename):
+		h = hashlib.sha256()
+		n = 0
+		fd = os.open(filename, os.O_RDONLY)
+		try:
+			if hasattr(os, 'posix_fadvise'):
+				os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+			with open(fd, 'rb', buffering=0, closefd=False) as f:
+				while True:
+					r = f.readinto(self.buf)
+					if not r:
+						break
+					h.update(self.view[:r])
+					n += r
+		finally:
+			os.close(fd)
+		return h.hexdigest(), n
+
+	def verify(self, directory, manifest):
+		result = Verify_result(directory)
+		start = time.perf_counter()
+		try:
+			entries = Sha256_verifier.parse_manifest(os.path.join(directory, manifest))
+		except OSError:
+			return result
+		for digest, name in entries:
+			result.files += 1
+			try:
+				d, n = self.hash_file(os.path.join(directory, name))
+			except OSError:
+				result.failed.append(name)
+				continue
+			result.nbytes += n
+			if d != digest:
+				result.failed.append(name)
+		result.elapsed = time.perf_counter() - start
+		return result
+
+###############################################################################
+#	class Interface_info
+###############################################################################
+class Interface_info:
+	SIOCGIFADDR = 0x8915
+	# last query per interface, kept warm between testd.py requests
+	cache = dict()
+
+	def __init__(self, name):
+		self.name = name
+		self.ts = time.monotonic()
+		self.operstate = None
+		self.carrier = None
+		self.speed = None
+		self.duplex = None
+		self.mac_address = None
+		self.ip_addresses = []
+
+	def get_ip_address(self):
+		if len(self.ip_addresses) == 0:
+			return None
+		return self.ip_addresses[0]
+
+	def read_attr(if_name, attr):
+		try:
+			return read_str_from_file('/sys/class/net/%s/%s' % (if_name, attr))
+		except OSError:
+			# carrier, speed and duplex are not readable while the link is down
+			return None
+
+	def read_ipv4_address(if_name):
+		s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		try:
+			ifreq = fcntl.ioctl(s.fileno(), Interface_info.SIOCGIFADDR, struct.pack('256s', if_name.encode('utf-8')[:15]))
+			return socket.inet_ntoa(ifreq[20:24])
+		except OSError:
+			return None
+		finally:
+			s.close()
+
+	def query(if_name):
+		if not os.path.exists('/sys/class/net/%s' % if_name):
+			return None
+		info = Interface_info(if_name)
+		info.operstate = Interface_info.read_attr(if_name, 'operstate')
+		info.mac_address = Interface_info.read_attr(if_name, 'address')
+		info.duplex = Interface_info.read_attr(if_name, 'duplex')
+		carrier = Interface_info.read_attr(if_name, 'carrier')
+		if carrier != None:
+			info.carrier = (carrier == '1')
+		speed = Interface_info.read_attr(if_name, 'speed')
+		if speed != None and int(speed) > 0:
+			info.speed = int(speed)
+		ip_address = Interface_info.read_ipv4_address(if_name)
+		if ip_address != None:
+			info.ip_addresses.append(ip_address)
+		Interface_info.cache[if_name] = info
+		return info
+
+	def get(if_name, validity):
+		# short validity, link state is what the tests check
+		info = Interface_info.cache.get(if_name)
+		if info == None or time.monotonic() - info.ts > validity or not os.path.exists('/sys/class/net/%s' % if_name):
+			return Interface_info.query(if_name)
+		return info
+
+###############################################################################
+#	class Dhcp_lease
+###############################################################################
+class Dhcp_lease:
+	def path(if_name):
+		return get_tempdir() + '/lease_%s.json' % if_name
+
+	def load(if_name, validity):
+		try:
+			with open(Dhcp_lease.path(if_name)) as f:
+				lease = json.load(f)
+		except (OSError, ValueError):
+			return None
+		if time.time() - lease['ts'] > validity:
+			return None
+		return lease['ip']
+
+	def store(if_name, ip_address):
+		os.umask(0)
+		with open(Dhcp_lease.path(if_name), 'w') as f:
+			json.dump({ 'ip': ip_address, 'ts': time.time() }, f)
+
+	def clear(if_name):
+		if os.path.exists(Dhcp_lease.path(if_name)):
+			os.remove(Dhcp_lease.path(if_name))
+
+###############################################################################
+#	class Ping_result
+###############################################################################
+class Ping_result:
+	def __init__(self, target):
+		self.target = target
+		self.sent = 0
+		self.rtts = []
+
+	def received(self):
+		return len(self.rtts)
+
+	def loss(self):
+		if self.sent == 0:
+			return 100.0
+		return 100.0 * (self.sent - len(self.rtts)) / self.sent
+
+	def min(self):
+		return min(self.rtts)
+
+	def max(self):
+		return max(self.rtts)
+
+	def avg(self):
+		return sum(self.rtts) / len(self.rtts)
+
+	def mdev(self):
+		avg = self.avg()
+		return math.sqrt(max(sum([r * r for r in self.rtts]) / len(self.rtts) - avg * avg, 0))
+
+###############################################################################
+#	class Pinger
+###############################################################################
+class Pinger:
+	ICMP_ECHO_REPLY = 0
+	ICMP_ECHO_REQUEST = 8
+
+	def __init__(self, target, size=56):
+		self.target = socket.gethostbyname(target)
+		self.size = size
+		self.ident = os.getpid() & 0xffff
+		try:
+			# unprivileged ICMP, the kernel matches replies on the socket id
+			self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+			self.raw = False
+		except OSError:
+			self.sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+			self.raw = True
+
+	def close(self):
+		self.sock.close()
+
+	def checksum(data):
+		if len(data) % 2:
+			data += b'\0'
+		s = sum(struct.unpack('!%dH' % (len(data) // 2), data))
+		s = (s >> 16) + (s & 0xffff)
+		s += s >> 16
+		return ~s & 0xffff
+
+	def send(self, seq):
+		payload = bytes(self.size)
+		header = struct.pack('!BBHHH', Pinger.ICMP_ECHO_REQUEST, 0, 0, self.ident, seq)
+		c = Pinger.checksum(header + payload)
+		header = struct.pack('!BBHHH', Pinger.ICMP_ECHO_REQUEST, 0, c, self.ident, seq)
+		self.sock.sendto(header + payload, (self.target, 0))
+
+	def receive(self):
+		data, addr = self.sock.recvfrom(self.size + 128)
+		if self.raw:
+			data = data[(data[0] & 0x0f) * 4:]
+		if len(data) < 8 or addr[0] != self.target:
+			return None
+		t, code, c, ident, seq = struct.unpack('!BBHHH', data[:8])
+		if t != Pinger.ICMP_ECHO_REPLY or (self.raw and ident != self.ident):
+			return None
+		return seq
+
+	def run(self, count=3, interval=1.0, deadline=10.0, timeout=1.0, fail_fast=False):
+		result = Ping_result(self.target)
+		pending = dict()
+		start = time.perf_counter()
+		next_send = start
+		last_send = None
+		while True:
+			now = time.perf_counter()
+			if now - start >= deadline:
+				break
+			if result.sent < count and now >= next_send:
+				seq = result.sent & 0xffff
+				pending[seq] = now
+				self.send(seq)
+				result.sent += 1
+				last_send = now
+				next_send += interval
+				continue
+			if result.sent >= count:
+				if len(pending) == 0 or now - last_send >= timeout:
+					break
+				wait = min(last_send + timeout, start + deadline) - now
+			else:
+				wait = min(next_send, start + deadline) - now
+			readable, writable, exceptional = select.select([self.sock], [], [], max(wait, 0))
+			if len(readable) == 0:
+				continue
+			seq = self.receive()
+			if seq in pending:
+				result.rtts.append((time.perf_counter() - pending.pop(seq)) * 1000.0)
+				if fail_fast:
+					break
+		return result
+
+###############################################################################
+#	class Throughput_result
+###############################################################################
+class Throughput_result:
+	def __init__(self):
+		self.nbytes = 0
+		self.elapsed = 0.0
+		self.sent = 0
+		self.received = 0
+		self.jitter = 0.0
+
+	def mbps(self):
+		if self.elapsed <= 0:
+			return 0.0
+		return self.nbytes * 8 / self.elapsed / 1000000.0
+
+	def loss(self):
+		if self.sent == 0:
+			return 0.0
+		return 100.0 * (self.sent - self.received) / self.sent
+
+###############################################################################
+#	class Throughput
+###############################################################################
+class Throughput:
+	# protocol shared with reflector.py
+	PORT = 5201
+	MODE_SINK = b'S'
+	MODE_SOURCE = b'T'
+	TCP_HEADER = struct.Struct('!cd')
+	TCP_REPORT = struct.Struct('!Q')
+	UDP_HEADER = struct.Struct('!IQ')
+	UDP_DONE = 0xffffffff
+	UDP_REPORT = struct.Struct('!QQd')
+
+	def __init__(self, host, port=PORT, bufsize=128*1024):
+		self.host = host
+		self.port = port
+		self.buf = bytearray(bufsize)
+		self.view = memoryview(self.buf)
+		self.source = None
+
+	def close(self):
+		if self.source != None:
+			self.source.close()
+			self.source = None
+
+	def source_file(bufsize):
+		# sendfile() needs a file, its pages are sent without copying through Python
+		import tempfile
+		f = tempfile.TemporaryFile()
+		f.write(bytes(bufsize))
+		f.flush()
+		return f
+
+	def recv_exact(sock, n):
+		data = b''
+		while len(data) < n:
+			r = sock.recv(n - len(data))
+			if not r:
+				raise ConnectionError('connection closed')
+			data += r
+		return data
+
+	def tcp_send(self, duration):
+		if self.source == None:
+			self.source = Throughput.source_file(len(self.buf))
+		result = Throughput_result()
+		with socket.create_connection((self.host, self.port), timeout=5.0) as sock:
+			sock.sendall(Throughput.TCP_HEADER.pack(Throughput.MODE_SINK, duration))
+			start = time.monotonic()
+			while time.monotonic() - start < duration:
+				sock.sendfile(self.source, 0, len(self.buf))
+			sock.shutdown(socket.SHUT_WR)
+			# bytes the reflector got, in-flight data included in the time
+			result.nbytes = Throughput.TCP_REPORT.unpack(Throughput.recv_exact(sock, Throughput.TCP_REPORT.size))[0]
+			result.elapsed = time.monotonic() - start
+		return result
+
+	def tcp_receive(self, duration):
+		result = Throughput_result()
+		with socket.create_connection((self.host, self.port), timeout=5.0) as sock:
+			sock.sendall(Throughput.TCP_HEADER.pack(Throughput.MODE_SOURCE, duration))
+			start = time.monotonic()
+			while True:
+				r = sock.recv_into(self.view)
+				if not r:
+					break
+				result.nbytes += r
+			result.elapsed = time.monotonic() - start
+		return result
+
+	def udp(self, duration, rate_mbps, size):
+		result = Throughput_result()
+		interval = size * 8 / (rate_mbps * 1000000.0)
+		with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+			sock.connect((self.host, self.port))
+			start = time.monotonic()
+			due = start
+			while True:
+				now = time.monotonic()
+				if now - start >= duration:
+					break
+				Throughput.UDP_HEADER.pack_into(self.buf, 0, result.sent, time.monotonic_ns())
+				try:
+					sock.send(self.view[:size])
+					result.sent += 1
+				except ConnectionRefusedError:
+					# ICMP from a previous datagram, the reflector is not there
+					raise OSError('no reflector on %s:%d/udp' % (self.host, self.port))
+				except OSError:
+					# socket buffer full, counted as lost
+					result.sent += 1
+				due += interval
+				if due - now > 0.001:
+					time.sleep(due - now)
+			result.elapsed = time.monotonic() - start
+			sock.settimeout(0.5)
+			for i in range(5):
+				sock.send(Throughput.UDP_HEADER.pack(Throughput.UDP_DONE, result.sent))
+				try:
+					data = sock.recv(64)
+				except socket.timeout:
+					continue
+				if len(data) == Throughput.UDP_REPORT.size:
+					result.received, result.nbytes, result.jitter = Throughput.UDP_REPORT.unpack(data)
+					return result
+		raise OSError('no report from %s:%d/udp' % (self.host, self.port))
+
+###############################################################################
+#	class Sntp_sample
+###############################################################################
+class Sntp_sample:
+	def __init__(self, peer, offset, delay, stratum):
+		self.peer = peer
+		self.offset = offset
+		self.delay = delay
+		self.stratum = stratum
+
+###############################################################################
+#	class Sntp_protocol
+###############################################################################
+class Sntp_protocol:
+	# asyncio datagram protocol, no base class so asyncio loads only when used
+	def __init__(self):
+		self.reply = None
+
+	def connection_made(self, transport):
+		pass
+
+	def connection_lost(self, exc):
+		pass
+
+	def datagram_received(self, data, addr):
+		if self.reply != None and not self.reply.done():
+			self.reply.set_result((data, time.time()))
+
+	def error_received(self, exc):
+		if self.reply != None and not self.reply.done():
+			self.reply.set_exception(exc)
+
+###############################################################################
+#	class Sntp_client
+###############################################################################
+class Sntp_client:
+	# seconds from 1900 (NTP era 0) to 1970
+	NTP_DELTA = 2208988800
+	PORT = 123
+
+	def __init__(self, peers, samples=4, timeout=1.0):
+		self.peers = peers
+		self.samples = samples
+		self.timeout = timeout
+		self.results = dict()
+
+	def to_ntp(t):
+		return int((t + Sntp_client.NTP_DELTA) * 4294967296.0)
+
+	def from_ntp(ts):
+		return ts / 4294967296.0 - Sntp_client.NTP_DELTA
+
+	def parse(peer, data, tx, t4):
+		if len(data) < 48:
+			return None
+		li_vn_mode, stratum, poll, precision, root_delay, root_dispersion, ref_id, ref_ts, orig_ts, recv_ts, tx_ts = struct.unpack('!BBbbIIIQQQQ', data[:48])
+		# server mode, synchronized, stratum 0 is a kiss-o'-death
+		if li_vn_mode & 7 != 4 or li_vn_mode >> 6 == 3 or stratum == 0 or stratum > 15:
+			return None
+		if orig_ts != tx or tx_ts == 0:
+			return None
+		t1 = Sntp_client.from_ntp(tx)
+		t2 = Sntp_client.from_ntp(recv_ts)
+		t3 = Sntp_client.from_ntp(tx_ts)
+		offset = ((t2 - t1) + (t3 - t4)) / 2
+		delay = (t4 - t1) - (t3 - t2)
+		return Sntp_sample(peer, offset, delay, stratum)
+
+	async def query_peer(self, peer):
+		import asyncio
+		host, sep, port = peer.partition(':')
+		loop = asyncio.get_running_loop()
+		transport, protocol = await loop.create_datagram_endpoint(Sntp_protocol, remote_addr=(host, int(port) if sep else Sntp_client.PORT))
+		best = None
+		try:
+			for i in range(self.samples):
+				protocol.reply = loop.create_future()
+				# LI 0, version 4, client mode; our send time in the transmit field
+				tx = Sntp_client.to_ntp(time.time())
+				transport.sendto(struct.pack('!B39xQ', 0x23, tx))
+				try:
+					data, t4 = await asyncio.wait_for(protocol.reply, self.timeout)
+				except asyncio.TimeoutError:
+					continue
+				sample = Sntp_client.parse(peer, data, tx, t4)
+				# the lowest delay sample has the least asymmetry
+				if sample != None and (best == None or sample.delay < best.delay):
+					best = sample
+		finally:
+			transport.close()
+		return best
+
+	async def query(self, deadline):
+		import asyncio
+		tasks = dict([(asyncio.ensure_future(self.query_peer(p)), p) for p in self.peers])
+		done, pending = await asyncio.wait(tasks.keys(), timeout=deadline)
+		for task in pending:
+			task.cancel()
+			self.results[tasks[task]] = 'deadline'
+		for task in done:
+			if task.exception() != None:
+				self.results[tasks[task]] = str(task.exception())
+			elif task.result() == None:
+				self.results[tasks[task]] = 'no valid reply'
+			else:
+				self.results[tasks[task]] = task.result()
+
+	def run(self, deadline):
+		# peer -> Sntp_sample, or the error as a string
+		import asyncio
+		asyncio.run(self.query(deadline))
+		return self.results
+
+	def best(self):
+		samples = [r for r in self.results.values() if isinstance(r, Sntp_sample)]
+		if len(samples) == 0:
+			return None
+		return min(samples, key=lambda r: (r.stratum, r.delay))
+
+	def set_clock(offset):
+		time.clock_settime_ns(time.CLOCK_REALTIME, time.clock_gettime_ns(time.CLOCK_REALTIME) + int(offset * 1e9))
+
+###############################################################################
+#	class Rtc
+###############################################################################
+class Rtc:
+	# linux/rtc.h, struct rtc_time is 9 ints
+	RTC_UIE_ON = 0x7003
+	RTC_UIE_OFF = 0x7004
+	RTC_RD_TIME = 0x80247009
+	RTC_SET_TIME = 0x4024700a
+	clocks = {
+		'monotonic': time.CLOCK_MONOTONIC,
+		'realtime': time.CLOCK_REALTIME
+	}
+
+	def __init__(self, path='/dev/rtc0'):
+		self.path = path
+		self.fd = os.open(path, os.O_RDONLY)
+		self.uie = False
+
+	def close(self):
+		if self.fd != None:
+			if self.uie:
+				fcntl.ioctl(self.fd, Rtc.RTC_UIE_OFF)
+			os.close(self.fd)
+			self.fd = None
+
+	def read_time(self):
+		# the RTC keeps UTC
+		tm = struct.unpack('9i', fcntl.ioctl(self.fd, Rtc.RTC_RD_TIME, bytes(36)))
+		return datetime.datetime(tm[5] + 1900, tm[4] + 1, tm[3], tm[2], tm[1], tm[0], tzinfo=datetime.timezone.utc)
+
+	def set_time(self, dt):
+		t = dt.astimezone(datetime.timezone.utc).timetuple()
+		fcntl.ioctl(self.fd, Rtc.RTC_SET_TIME, struct.pack('9i', t.tm_sec, t.tm_min, t.tm_hour, t.tm_mday, t.tm_mon - 1, t.tm_year - 1900, (t.tm_wday + 1) % 7, t.tm_yday - 1, 0))
+
+	def set_from_system(self):
+		# the RTC counts whole seconds, write it on a system second boundary
+		now = time.time()
+		time.sleep(math.ceil(now) - now)
+		self.set_time(datetime.datetime.fromtimestamp(round(time.time()), datetime.timezone.utc))
+
+	def wait_tick(self, timeout):
+		# update interrupt at each RTC second; drivers without UIE are polled
+		if not self.uie:
+			try:
+				fcntl.ioctl(self.fd, Rtc.RTC_UIE_ON)
+				self.uie = True
+			except OSError:
+				pass
+		if self.uie:
+			readable, writable, exceptional = select.select([self.fd], [], [], max(timeout, 0))
+			if len(readable) == 0:
+				return False
+			os.read(self.fd, struct.calcsize('L'))
+			return True
+		end = time.monotonic() + timeout
+		start = self.read_time()
+		while time.monotonic() < end:
+			if self.read_time() != start:
+				return True
+			time.sleep(0.0001)
+		return False
+
+	def flush(self):
+		# interrupts that fired while nobody waited
+		while self.uie and len(select.select([self.fd], [], [], 0)[0]) > 0:
+			os.read(self.fd, struct.calcsize('L'))
+
+	def measure_drift(self, window, clock='monotonic'):
+		# RTC seconds counted between two update edges against the reference clock, in ppm
+		self.flush()
+		if not self.wait_tick(2.0):
+			return None
+		t0 = time.clock_gettime(Rtc.clocks[clock])
+		rtc0 = self.read_time()
+		time.sleep(max(window - 0.5, 0))
+		self.flush()
+		if not self.wait_tick(2.0):
+			return None
+		t1 = time.clock_gettime(Rtc.clocks[clock])
+		rtc1 = self.read_time()
+		elapsed = t1 - t0
+		return ((rtc1 - rtc0).total_seconds() - elapsed) / elapsed * 1e6
+
+###############################################################################
+#	class Probe_result
+###############################################################################
+class Probe_result:
+	def __init__(self, name, ok, value, error=None):
+		self.name = name
+		self.ok = ok
+		self.value = value
+		self.error = error
+		self.duration = 0.0
+
+###############################################################################
+#	class Probe_engine
+###############################################################################
+class Probe_engine:
+	def __init__(self, probes, jobs=8):
+		self.probes = probes
+		self.jobs = jobs
+		self.kmsg = None
+		self.kmsg_groups = dict()
+		self.exported = []
+
+	def setup(self):
+		# one kernel log pass for every kmsg probe
+		signatures = dict()
+		for p in self.probes:
+			if p['type'] == 'kmsg':
+				group = 'p%d' % len(signatures)
+				signatures[group] = p['pattern']
+				self.kmsg_groups[p['name']] = group
+		if len(signatures) > 0:
+			try:
+				self.kmsg = Kmsg_reader(signatures)
+				self.kmsg.scan()
+			except OSError:
+				self.kmsg = None
+		for p in self.probes:
+			if p['type'] in ['gpio', 'frequency'] and p['line'] in Gpio.gpio_table and p['line'] not in self.exported:
+				try:
+					if Gpio.is_exported(p['line']):
+						continue
+					Gpio.export(p['line'])
+					Gpio.set_direction(p['line'], 'in')
+					self.exported.append(p['line'])
+				except OSError:
+					pass
+
+	def cleanup(self):
+		if self.kmsg != None:
+			self.kmsg.close()
+			self.kmsg = None
+		for line in self.exported:
+			try:
+				Gpio.unexport(line)
+			except OSError:
+				pass
+		self.exported = []
+
+	def probe_sysfs(self, p):
+		value = Sysfs.read_str(p['path'])
+		if 'value' in p:
+			return value == str(p['value']), value
+		if 'regex' in p:
+			return re.search(p['regex'], value) != None, value
+		n = int(value)
+		return p.get('min', n) <= n <= p.get('max', n), n
+
+	def probe_device(self, p):
+		return os.path.exists(p['path']), p['path']
+
+	def probe_kmsg(self, p):
+		if self.kmsg == None:
+			raise OSError('kernel log not readable')
+		record = self.kmsg.matches.get(self.kmsg_groups[p['name']])
+		if record == None:
+			return False, None
+		return True, record.text
+
+	def probe_gpio(self, p):
+		value = Gpio.read(p['line'])
+		return value == p.get('value', value), value
+
+	def probe_frequency(self, p):
+		hz, edges = Gpio.measure_frequency(p['line'], p.get('window', 1.0))
+		return p.get('min', hz) <= hz <= p.get('max', hz), round(hz, 1)
+
+	def probe_interface(self, p):
+		info = Interface_info.query(p['interface'])
+		if info == None:
+			return False, None
+		ok = info.operstate == p.get('operstate', 'up')
+		if 'speed' in p:
+			ok = ok and info.speed != None and info.speed >= p['speed']
+		return ok, info.operstate
+
+	def probe_checksum(self, p):
+		# probes run in parallel, each needs its own buffer
+		digest, n = Sha256_verifier(256*1024).hash_file(p['path'])
+		return digest == p['sha256'].lower(), digest
+
+	def evaluate(self, p):
+		start = time.perf_counter()
+		f = getattr(self, 'probe_%s' % p['type'], None)
+		if f == None:
+			return Probe_result(p['name'], False, None, 'unknown probe type \'%s\'' % p['type'])
+		try:
+			ok, value = f(p)
+			result = Probe_result(p['name'], ok, value)
+		except (OSError, ValueError, KeyError) as e:
+			result = Probe_result(p['name'], False, None, str(e))
+		result.duration = time.perf_counter() - start
+		return result
+
+	def run(self):
+		import concurrent.futures
+		self.setup()
+		try:
+			with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+				return list(executor.map(self.evaluate, self.probes))
+		finally:
+			self.cleanup()
+
+###############################################################################
+#	get_board_serial
+###############################################################################
+board_serial = None
+
+def get_board_serial():
+	global board_serial
+	if board_serial == None:
+		for f in ['/proc/device-tree/serial-number', '/sys/firmware/devicetree/base/serial-number']:
+			try:
+				with open(f, 'rb') as fd:
+					board_serial = fd.read().rstrip(b'\0\n').decode('ascii', 'replace')
+				break
+			except OSError:
+				pass
+		else:
+			board_serial = socket.gethostname()
+	return board_serial
+
+###############################################################################
+#	class Results_store
+###############################################################################
+class Results_store:
+	connections = dict()
+
+	def __init__(self, path):
+		# sqlite connections can not be shared between threads
+		key = (path, threading.get_ident())
+		if key not in Results_store.connections:
+			db = sqlite3.connect(path, timeout=10)
+			db.execute('PRAGMA journal_mode=WAL')
+			db.execute('CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, serial TEXT, test TEXT, iteration INTEGER, ts REAL, duration REAL, status TEXT, code TEXT, info TEXT)')
+			db.execute('CREATE INDEX IF NOT EXISTS runs_serial ON runs (serial, ts)')
+			db.execute('CREATE INDEX IF NOT EXISTS runs_test ON runs (test, ts)')
+			db.execute('CREATE INDEX IF NOT EXISTS runs_ts ON runs (ts)')
+			db.commit()
+			Results_store.connections[key] = db
+		self.db = Results_store.connections[key]
+
+	def add(self, serial, test, iteration, ts, duration, status, code, info):
+		with self.db:
+			self.db.execute('INSERT INTO runs (serial, test, iteration, ts, duration, status, code, info) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+				(serial, test, iteration, ts, duration, status, code, json.dumps(info, default=str)))
+
+	def where(self, serial, test, since, until):
+		cond = []
+		params = []
+		for column, op, value in [('serial', '=', serial), ('test', '=', test), ('ts', '>=', since), ('ts', '<', until)]:
+			if value != None:
+				cond.append('%s %s ?' % (column, op))
+				params.append(value)
+		if len(cond) == 0:
+			return '', params
+		return ' WHERE ' + ' AND '.join(cond), params
+
+	def query(self, serial=None, test=None, since=None, until=None):
+		w, params = self.where(serial, test, since, until)
+		records = []
+		for r in self.db.execute('SELECT serial, test, iteration, ts, duration, status, code, info FROM runs' + w + ' ORDER BY ts', params):
+			records.append({
+				'serial': r[0], 'test': r[1], 'iteration': r[2], 'ts': r[3],
+				'duration': r[4], 'status': r[5], 'code': r[6], 'info': json.loads(r[7])
+			})
+		return records
+
+	def summary(self, serial=None, test=None, since=None, until=None):
+		w, params = self.where(serial, test, since, until)
+		summary = dict()
+		for r in self.db.execute('SELECT test, COUNT(*), SUM(status != \'OK\'), AVG(duration), MAX(duration) FROM runs' + w + ' GROUP BY test ORDER BY test', params):
+			summary[r[0]] = { 'runs': r[1], 'failed': r[2], 'avg_duration': r[3], 'max_duration': r[4] }
+		return summary
+
+###############################################################################
+#	class Log_writer
+###############################################################################
+class Log_writer(threading.Thread):
+	instance = None
+
+	def get():
+		if Log_writer.instance == None:
+			Log_writer.instance = Log_writer()
+			Log_writer.instance.start()
+			atexit.register(Log_writer.instance.flush)
+		return Log_writer.instance
+
+	def __init__(self, size=4096, batch=256):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.queue = queue.Queue(size)
+		self.batch = batch
+
+	def put(self, record):
+		self.queue.put(record)
+
+	def flush(self):
+		self.queue.join()
+
+	def run(self):
+		while True:
+			records = [self.queue.get()]
+			try:
+				while len(records) < self.batch:
+					records.append(self.queue.get_nowait())
+			except queue.Empty:
+				pass
+			for r in records:
+				try:
+					r[0].write_record(*r[1:])
+				except (OSError, ValueError):
+					pass
+			try:
+				sys.stdout.flush()
+			except (OSError, ValueError):
+				pass
+			for r in records:
+				self.queue.task_done()
+
+###############################################################################
+#	class Phase
+###############################################################################
+class Phase:
+	def __init__(self, test, name):
+		self.test = test
+		self.name = name
+		self.path = None
+		self.begin = None
+
+	def __enter__(self):
+		self.test.phases.append(self.name)
+		self.path = '.'.join(self.test.phases)
+		self.begin = time.perf_counter()
+		return self
+
+	def __exit__(self, exc_type, exc_value, tb):
+		end = time.perf_counter()
+		self.test.phases.pop()
+		self.test.info('phase_%s' % self.path, '{:0.3f}'.format(end - self.begin))
+		self.test.add_trace_event(self.path, self.begin, end)
+		return False
+
+###############################################################################
+#	class Test_timeout
+###############################################################################
+class Test_timeout(BaseException):
+	# SIGALRM of the in-process scheduler, not an Exception so that tests
+	# cannot swallow it, run() turns it into a TIMEOUT error
+	def handler(signum, frame):
+		raise Test_timeout()
 
 ###############################################################################
 #	class Test_error
@@ -88,22 +1569,37 @@ class Test_error(Exception):
 #	class Test_basic
 ###############################################################################
 class Test_basic:
+	last_result = None
+	err_codes = {
+		'NON_ROOT': 'Non root',
+		'DEV_NOT_FOUND': 'Device \'%s\' not found',
+		'RE_NOT_MATCH': 'Regular expression not match in string \'%s\'',
+		'MISSING_VERSION': 'Missing version file',
+		'NO_IP_ADDR': 'IP address not acquired from DHCP server',
+		'EVENT_NOT_RECEIVED': 'Event \'%s\' not received',
+		'TIMEOUT': 'Timeout after %s s'
+	}
+	COLOR_SUCCESS = '\033[92m'
+	COLOR_INFO = '\033[96m'
+	COLOR_ERROR = '\033[91m'
+	COLOR_DEBUG = '\033[94m'
+	COLOR_WARNING = '\033[93m'
+	COLOR_MESSAGE = '\033[94m'
+	COLOR_DEFAULT = '\033[39m'
+	colors = {
+		'OK': COLOR_SUCCESS,
+		'INF': COLOR_INFO,
+		'ERR': COLOR_ERROR,
+		'DBG': COLOR_DEBUG,
+		'WRN': COLOR_WARNING,
+		'MSG': COLOR_MESSAGE
+	}
+
 	def __init__(self, name):
 		self.start = time.time()
-		self.err_dict = { 
-			'NON_ROOT': 'Non root', 
-			'DEV_NOT_FOUND': 'Device \'%s\' not found',
-			'RE_NOT_MATCH': 'Regular expression not match in string \'%s\'',
-			'MISSING_VERSION': 'Missing version file',
-			'NO_IP_ADDR': 'IP address not acquired from DHCP server'
-		}
-		self.COLOR_SUCCESS = '\033[92m'
-		self.COLOR_INFO = '\033[96m'
-		self.COLOR_ERROR = '\033[91m'
-		self.COLOR_DEBUG = '\033[94m'
-		self.COLOR_WARNING = '\033[93m'
-		self.COLOR_MESSAGE = '\033[94m'
-		self.COLOR_DEFAULT = '\033[39m'
+		self.start_perf = time.perf_counter()
+		# tests add their own codes, the class table stays untouched
+		self.err_dict = dict(Test_basic.err_codes)
 		self.load_config()
 		self.name = name
 		self.save_inf = False
@@ -111,6 +1607,15 @@ class Test_basic:
 		self.verbosity = 2
 		self.color = True
 		self.quiet = False
+		self.save_res = False
+		self.iteration = 0
+		self.infos = dict()
+		self.result = None
+		self.save_trace = False
+		self.phases = []
+		self.trace_events = []
+		self.profile = 'none'
+		self.profiler = None
 		self.log_file = None
 		self.inf_file = None
 		self.printk_backup = None
@@ -121,6 +1626,10 @@ class Test_basic:
 		parser.add_argument('-v', '--verbosity', type=int, choices=[0,1,2], default=self.config['verbosity'], help="set verbosity")
 		parser.add_argument('--color', type=str, choices=['yes', 'no'], default=self.config['colorize'], help="colorize the output")
 		parser.add_argument('-q', '--quiet', type=str, choices=['yes', 'no'], default=self.config['quiet'], help="set quiet mode")
+		parser.add_argument('--saveres', type=str, choices=['yes', 'no'], default=self.config['saveres'], help="save result record in the results database")
+		parser.add_argument('--iteration', type=int, default=0, help="set iteration number of the result record")
+		parser.add_argument('--savetrace', type=str, choices=['yes', 'no'], default=self.config['savetrace'], help="save phases as a Chrome trace file")
+		parser.add_argument('--profile', type=str, choices=['none', 'cprofile', 'tracemalloc'], default='none', help="profile the test")
 
 	def copy_common_arguments(self, args):
 		self.save_inf = (args.saveinf == 'yes')
@@ -128,15 +1637,19 @@ class Test_basic:
 		self.verbosity = args.verbosity
 		self.color = (args.color == 'yes')
 		self.quiet = (args.quiet == 'yes')
+		self.save_res = (args.saveres == 'yes')
+		self.iteration = args.iteration
+		self.save_trace = (args.savetrace == 'yes')
+		self.profile = args.profile
 
 	def load_config(self):
-		with open('config.json') as f:
-			self.config = json.load(f)
+		# shared between instances, must not be modified
+		self.config = load_cached('config.json', load_json_precompiled)
 
 	def get_test_version(self):
 		if not os.path.exists('version'):
 			raise Test_error(self, 'MISSING_VERSION')
-		return read_str_from_file('version')
+		return load_cached('version', read_str_from_file)
 
 	def open_log(self):
 		if self.save_log:
@@ -146,7 +1659,7 @@ class Test_basic:
 	def open_inf(self):
 		if self.save_inf:
 			os.umask(0)
-			self.inf_file = open(tempfile.gettempdir() + '/inf.txt', 'a')
+			self.inf_file = open(get_tempdir() + '/inf.txt', 'a')
 
 	def close_log(self):
 		if self.log_file != None:
@@ -163,16 +1676,91 @@ class Test_basic:
 		self.message('Start test [name=\'%s\', ver=\'%s\', ts=\'%s\']' % (self.name, self.get_test_version(), datetime.datetime.now()))
 		if os.getuid() != 0:
 			raise Test_error(self, 'NON_ROOT')
+		Gpio.configure(self.config['gpio'])
 		if self.quiet:
-			self.printk_backup = read_str_from_file('/proc/sys/kernel/printk')
-			write_int_to_file('/proc/sys/kernel/printk', 0)
+			self.printk_backup = Sysfs.read_str('/proc/sys/kernel/printk')
+			Sysfs.write_int('/proc/sys/kernel/printk', 0)
 		self.open_inf()
+		self.start_profile()
+
+	def start_profile(self):
+		if self.profile == 'cprofile':
+			import cProfile
+			self.profiler = cProfile.Profile()
+			self.profiler.enable()
+		elif self.profile == 'tracemalloc':
+			import tracemalloc
+			tracemalloc.start()
+
+	def stop_profile(self):
+		if self.profiler != None:
+			self.profiler.disable()
+			path = get_tempdir() + '/profile_%s.prof' % self.name
+			self.profiler.dump_stats(path)
+			self.profiler = None
+			self.debug('Profile saved to %s' % path)
+		elif self.profile == 'tracemalloc':
+			import tracemalloc
+			if not tracemalloc.is_tracing():
+				return
+			current, peak = tracemalloc.get_traced_memory()
+			for stat in tracemalloc.take_snapshot().statistics('lineno')[:10]:
+				self.debug('Memory %s' % stat)
+			tracemalloc.stop()
+			self.info('memory_peak', peak)
+
+	def phase(self, name):
+		return Phase(self, name)
+
+	def trace_path(name):
+		return get_tempdir() + '/trace_%s.json' % name
+
+	def add_trace_event(self, name, begin, end):
+		self.trace_events.append({
+			'name': name,
+			'cat': self.name,
+			'ph': 'X',
+			'ts': int((self.start + begin - self.start_perf) * 1000000),
+			'dur': int((end - begin) * 1000000),
+			'pid': os.getpid(),
+			'tid': 0
+		})
+
+	def write_trace(self):
+		if not self.save_trace:
+			return
+		self.add_trace_event(self.name, self.start_perf, time.perf_counter())
+		try:
+			os.umask(0)
+			with open(Test_basic.trace_path(self.name), 'w') as f:
+				json.dump({ 'traceEvents': self.trace_events, 'displayTimeUnit': 'ms' }, f)
+		except OSError as e:
+			self.warning('Save trace failed: %s' % e)
 
 	def finalize(self):
 		if self.printk_backup != None:
-			write_str_to_file('/proc/sys/kernel/printk', self.printk_backup)
+			Sysfs.write_str('/proc/sys/kernel/printk', self.printk_backup)
 			self.printk_backup = None
 
+	def save_result(self, status, code, te):
+		self.result = {
+			'test': self.name,
+			'iteration': self.iteration,
+			'ts': self.start,
+			'duration': te,
+			'status': status,
+			'code': code,
+			'info': self.infos
+		}
+		Test_basic.last_result = self.result
+		if not self.save_res:
+			return
+		try:
+			store = Results_store(self.config['results']['path'])
+			store.add(get_board_serial(), self.name, self.iteration, self.start, te, status, code, self.infos)
+		except sqlite3.Error as e:
+			self.warning('Save result failed: %s' % e)
+
 	def write_to_log(self, s):
 		if self.log_file != None:
 			self.log_file.write(s + '\n')
@@ -183,17 +1771,16 @@ class Test_basic:
 
 	def success(self):
 		self.finalize()
+		self.stop_profile()
+		self.write_trace()
 		te = time.time() - self.start
 		self.info('testDuration', '{:0.3f}'.format(te))
-		s = '{:08.3f}-{}-OK'.format(te, self.name)
-		if self.color:
-			print(self.COLOR_SUCCESS + s + self.COLOR_DEFAULT)
-		else:
-			print(s)
-		self.write_to_log(s)
+		self.log('OK', None, True, te)
+		self.save_result('OK', None, te)
+		self.flush_log()
 		self.close_inf()
 		self.close_log()
-		sys.exit(0)
+		return 0
 		
 	def error(self, code, value):
 		self.warning('RAISE %s' % code)
@@ -201,6 +1788,8 @@ class Test_basic:
 			self.finalize()
 		except Test_error as e:
 			pass
+		self.stop_profile()
+		self.write_trace()
 		if code in self.err_dict:
 			err_txt = self.err_dict[code]
 			if err_txt.find('%s') == -1:
@@ -211,60 +1800,90 @@ class Test_basic:
 			err_msg = 'Unknown error'
 		te = time.time() - self.start
 		self.info('duration', '{:0.3f}'.format(te))
-		s = '{:08.3f}-{}-ERR {} ({})'.format(te, self.name, code, err_msg)
-		if self.color:
-			print(self.COLOR_ERROR + s + self.COLOR_DEFAULT)
-		else:
-			print(s)
-		self.write_to_log(s)
+		self.log('ERR', '{} ({})'.format(code, err_msg), True, te)
+		self.save_result('ERR', code, te)
+		self.flush_log()
 		self.close_inf()
 		self.close_log()
-		sys.exit(-1)
+		return -1
+
+	def timeout(self):
+		# a test may use TIMEOUT for its own errors, the scheduler one wins here
+		self.err_dict['TIMEOUT'] = Test_basic.err_codes['TIMEOUT']
+		return self.error('TIMEOUT', '{:0.3f}'.format(time.time() - self.start))
 
 	def set_verbosity(self, level):
 		self.verbosity = level
-		
-	def info(self, name, value):
-		s = '{:08.3f}-{}-INF {}_{}={}'.format(time.time() - self.start, self.name, self.name, name, value)
-		if self.color:
-			print(self.COLOR_INFO + s + self.COLOR_DEFAULT)
-		else:
-			print(s)
-		self.write_to_log(s)
-		self.write_to_inf(name, value)
-		
-	def debug(self, msg):
-		s = '{:08.3f}-{}-DBG {}'.format(time.time() - self.start, self.name, msg)
-		if self.verbosity > 1:
+
+	def log(self, kind, text, console, te=None, inf=None):
+		if te == None:
+			te = time.time() - self.start
+		Log_writer.get().put((self, te, kind, text, console, inf))
+
+	def flush_log(self):
+		Log_writer.get().flush()
+
+	def write_record(self, te, kind, text, console, inf):
+		s = '{:08.3f}-{}-{}'.format(te, self.name, kind)
+		if text != None:
+			s += ' ' + text
+		if console:
 			if self.color:
-				print(self.COLOR_DEBUG + s + self.COLOR_DEFAULT)
+				sys.stdout.write(self.colors[kind] + s + self.COLOR_DEFAULT + '\n')
 			else:
-				print(s)
+				sys.stdout.write(s + '\n')
 		self.write_to_log(s)
+		if inf != None:
+			self.write_to_inf(inf[0], inf[1])
+
+	def info(self, name, value):
+		self.infos[name] = value
+		self.log('INF', '{}_{}={}'.format(self.name, name, value), True, inf=(name, value))
+		
+	def debug(self, msg):
+		if self.verbosity > 1 or self.log_file != None:
+			self.log('DBG', msg, self.verbosity > 1)
 
 	def warning(self, msg):
-		s = '{:08.3f}-{}-WRN {}'.format(time.time() - self.start, self.name, msg)
-		if self.color:
-			print(self.COLOR_WARNING + s + self.COLOR_DEFAULT)
-		else:
-			print(s)
-		self.write_to_log(s)
+		self.log('WRN', msg, True)
 
 	def message(self, msg):
-		s = '{:08.3f}-{}-MSG {}'.format(time.time() - self.start, self.name, msg)
-		if self.verbosity > 0:
-			if self.color:
-				print(self.COLOR_MESSAGE + s + self.COLOR_DEFAULT)
-			else:
-				print(s)
-		self.write_to_log(s)
+		if self.verbosity > 0 or self.log_file != None:
+			self.log('MSG', msg, self.verbosity > 0)
 	
 	def wait_for_device(self, d, timeout):
-		start_time = time.time()
-		while not os.path.exists(d):
-			if time.time() - start_time > timeout:
-				raise Test_error(self, 'DEV_NOT_FOUND', d)
-			time.sleep(.1)
+		t = wait_for_path(d, timeout)
+		if t == None:
+			raise Test_error(self, 'DEV_NOT_FOUND', d)
+		self.info('wait_%s' % os.path.basename(d), '{:0.3f}'.format(t))
+
+	def wait_for_uevent(self, listener, match, timeout):
+		start = time.perf_counter()
+		env = listener.wait(match, timeout)
+		if env == None:
+			raise Test_error(self, 'EVENT_NOT_RECEIVED', ','.join(['%s=%s' % (k, match[k]) for k in sorted(match)]))
+		self.info('wait_uevent_%s' % env.get('SUBSYSTEM', 'unknown'), '{:0.3f}'.format(time.perf_counter() - start))
+		return env
+
+	def acquire_ip_address(self, if_name, info=None):
+		validity = self.config['network']['lease_validity']
+		ip_address = Dhcp_lease.load(if_name, validity)
+		if ip_address != None:
+			if info == None:
+				info = Interface_info.get(if_name, self.config['network']['info_validity'])
+			if info != None and ip_address in info.ip_addresses:
+				self.debug('Reuse DHCP lease %s on \'%s\'' % (ip_address, if_name))
+				return info
+		import subprocess
+		Dhcp_lease.clear(if_name)
+		with self.phase('udhcpc'):
+			if subprocess.run(['udhcpc', '-n', '-i', if_name], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode != 0:
+				return None
+		info = Interface_info.query(if_name)
+		if info == None or info.get_ip_address() == None:
+			return None
+		Dhcp_lease.store(if_name, info.get_ip_address())
+		return info
 
 	def simple_re(self, s, r):
 		p = re.compile(r)
@@ -0,0 +1,149 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import json
+import shlex
+import asyncio
+import argparse
+
+###############################################################################
+#	class Board
+###############################################################################
+class Board:
+	ssh_options = [
+		'-o', 'BatchMode=yes',
+		'-o', 'ControlMaster=auto',
+		'-o', 'ControlPath=~/.ssh/gt5-%r@%h:%p',
+		'-o', 'ControlPersist=120'
+	]
+
+	def __init__(self, spec):
+		self.id = spec['id']
+		self.host = spec.get('host')
+		self.path = spec['path']
+		self.python = spec.get('python', 'python3')
+		self.returncode = None
+		self.summary = None
+
+	def command(self, cmd):
+		cmd = 'cd %s && %s' % (shlex.quote(self.path), cmd)
+		if self.host == None:
+			# local stand-in, the board is a directory on this host
+			return ['sh', '-c', cmd]
+		# the ssh master connection is shared by every command to this board
+		return ['ssh'] + Board.ssh_options + [self.host, cmd]
+
+	def failed_tests(self):
+		if self.summary == None:
+			return []
+		# with --nostop the scheduler exits 0 even when tests failed
+		return [r['test'] for r in self.summary if r['failed'] > 0]
+
+	def summary_path(self):
+		return '/tmp/fleet_summary_%s.json' % self.id
+
+	async def run(self, cmd, out):
+		p = await asyncio.create_subprocess_exec(*self.command(cmd), stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+		while True:
+			line = await p.stdout.readline()
+			if not line:
+				break
+			out(self, line.decode('utf-8', 'replace').rstrip('\n'))
+		return await p.wait()
+
+	async def read(self, cmd):
+		p = await asyncio.create_subprocess_exec(*self.command(cmd), stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+		data, err = await p.communicate()
+		if p.returncode != 0:
+			return None
+		return data
+
+###############################################################################
+#	class Fleet
+###############################################################################
+class Fleet:
+	def __init__(self, boards, args, parallel, quiet):
+		self.boards = boards
+		self.args = args
+		self.parallel = parallel
+		self.quiet = quiet
+
+	def output(self, board, line):
+		if not self.quiet:
+			sys.stdout.write('[%s] %s\n' % (board.id, line))
+			sys.stdout.flush()
+
+	async def run_board(self, board, semaphore):
+		async with semaphore:
+			cmd = '%s scheduler.py --summary %s %s' % (board.python, board.summary_path(), ' '.join([shlex.quote(a) for a in self.args]))
+			try:
+				board.returncode = await board.run(cmd, self.output)
+				data = await board.read('cat %s && rm -f %s' % (board.summary_path(), board.summary_path()))
+			except OSError as e:
+				self.output(board, 'fleet.py: %s' % e)
+				board.returncode = -1
+				return
+			if data != None:
+				try:
+					board.summary = json.loads(data.decode('utf-8'))
+				except ValueError:
+					self.output(board, 'fleet.py: invalid summary')
+
+	async def start(self):
+		semaphore = asyncio.Semaphore(self.parallel)
+		await asyncio.gather(*[self.run_board(b, semaphore) for b in self.boards])
+
+	def results(self):
+		return [{ 'id': b.id, 'host': b.host, 'returncode': b.returncode, 'summary': b.summary } for b in self.boards]
+
+	def show_report(self):
+		print('------------------------------')
+		print('   Fleet report')
+		print('------------------------------')
+		for b in self.boards:
+			failed = b.failed_tests()
+			if b.returncode != 0:
+				status = 'FAIL (%s)' % b.returncode
+			elif len(failed) > 0:
+				status = 'FAIL'
+			else:
+				status = 'OK'
+			print('{:16} {:12} {}'.format(b.id, status, ', '.join(failed)))
+
+###############################################################################
+parser = argparse.ArgumentParser(description='Run the scheduler on many boards', epilog='arguments after -- are passed to scheduler.py')
+parser.add_argument('-b', '--boards', type=str, default=None, help="set JSON file with the board list (default: fleet.boards in config.json)")
+parser.add_argument('-l', '--local', type=str, action='append', default=[], help="add a local stand-in board running in directory LOCAL")
+parser.add_argument('-p', '--parallel', type=int, default=16, help="set number of boards driven at once")
+parser.add_argument('-o', '--output', type=str, default=None, help="write collected results to a JSON file")
+parser.add_argument('-q', '--quiet', action="store_true", help="do not stream board output")
+parser.add_argument('args', nargs=argparse.REMAINDER, help="scheduler arguments")
+args = parser.parse_args()
+
+sched_args = args.args
+if len(sched_args) > 0 and sched_args[0] == '--':
+	sched_args = sched_args[1:]
+
+if args.boards != None:
+	with open(args.boards) as f:
+		specs = json.load(f)
+elif len(args.local) > 0:
+	specs = []
+else:
+	with open('config.json') as f:
+		specs = json.load(f)['fleet']['boards']
+for i in range(len(args.local)):
+	specs.append({ 'id': 'local%d' % (i + 1), 'path': os.path.abspath(args.local[i]) })
+
+fleet = Fleet([Board(s) for s in specs], sched_args, args.parallel, args.quiet)
+asyncio.run(fleet.start())
+fleet.show_report()
+
+if args.output != None:
+	with open(args.output, 'w') as f:
+		json.dump(fleet.results(), f, indent=1)
+
+for b in fleet.boards:
+	if b.returncode != 0 or len(b.failed_tests()) > 0:
+		sys.exit(1)
@@ -0,0 +1,130 @@
+#!/usr/bin/python3
+
+import sys
+import time
+import socket
+import argparse
+import threading
+import socketserver
+from common import Throughput
+
+###############################################################################
+#	class Tcp_handler
+###############################################################################
+class Tcp_handler(socketserver.BaseRequestHandler):
+	def handle(self):
+		sock = self.request
+		try:
+			mode, duration = Throughput.TCP_HEADER.unpack(Throughput.recv_exact(sock, Throughput.TCP_HEADER.size))
+			if mode == Throughput.MODE_SINK:
+				self.sink(sock)
+			elif mode == Throughput.MODE_SOURCE:
+				self.source(sock, min(duration, self.server.max_duration))
+		except OSError as e:
+			self.server.log('tcp %s: %s' % (self.client_address[0], e))
+
+	def sink(self, sock):
+		view = memoryview(bytearray(self.server.bufsize))
+		n = 0
+		while True:
+			r = sock.recv_into(view)
+			if not r:
+				break
+			n += r
+		sock.sendall(Throughput.TCP_REPORT.pack(n))
+		self.server.log('tcp %s: received %d bytes' % (self.client_address[0], n))
+
+	def source(self, sock, duration):
+		start = time.monotonic()
+		n = 0
+		while time.monotonic() - start < duration:
+			n += sock.sendfile(self.server.source, 0, self.server.bufsize)
+		sock.shutdown(socket.SHUT_WR)
+		self.server.log('tcp %s: sent %d bytes' % (self.client_address[0], n))
+
+###############################################################################
+#	class Tcp_server
+###############################################################################
+class Tcp_server(socketserver.ThreadingTCPServer):
+	allow_reuse_address = True
+	daemon_threads = True
+
+	def __init__(self, address, bufsize, max_duration, verbose):
+		socketserver.ThreadingTCPServer.__init__(self, address, Tcp_handler)
+		self.bufsize = bufsize
+		self.max_duration = max_duration
+		self.verbose = verbose
+		self.source = Throughput.source_file(bufsize)
+
+	def log(self, s):
+		if self.verbose:
+			print(s)
+
+###############################################################################
+#	class Udp_stats
+###############################################################################
+class Udp_stats:
+	def __init__(self):
+		self.received = 0
+		self.nbytes = 0
+		self.transit = None
+		self.jitter = 0.0
+
+	def add(self, size, send_ns, arrival_ns):
+		self.received += 1
+		self.nbytes += size
+		# RFC 3550 interarrival jitter, the clock offset cancels out
+		transit = (arrival_ns - send_ns) / 1e9
+		if self.transit != None:
+			self.jitter += (abs(transit - self.transit) - self.jitter) / 16
+		self.transit = transit
+
+###############################################################################
+#	class Udp_reflector
+###############################################################################
+class Udp_reflector:
+	def __init__(self, address, verbose):
+		self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+		self.sock.bind(address)
+		self.view = memoryview(bytearray(65536))
+		self.stats = dict()
+		self.verbose = verbose
+
+	def serve_forever(self):
+		while True:
+			n, addr = self.sock.recvfrom_into(self.view)
+			arrival_ns = time.monotonic_ns()
+			if n < Throughput.UDP_HEADER.size:
+				continue
+			seq, value = Throughput.UDP_HEADER.unpack_from(self.view)
+			if seq == Throughput.UDP_DONE:
+				s = self.stats.get(addr, Udp_stats())
+				self.sock.sendto(Throughput.UDP_REPORT.pack(s.received, s.nbytes, s.jitter), addr)
+				if self.verbose and s.received > 0:
+					print('udp %s: received %d/%d datagrams, jitter %0.3f ms' % (addr[0], s.received, value, s.jitter * 1000.0))
+				continue
+			if seq == 0 or addr not in self.stats:
+				self.stats[addr] = Udp_stats()
+			self.stats[addr].add(n, value, arrival_ns)
+
+###############################################################################
+parser = argparse.ArgumentParser(description='Throughput reflector for test_ethernet')
+parser.add_argument('-b', '--bind', type=str, default='0.0.0.0', help="set address to listen on")
+parser.add_argument('-p', '--port', type=int, default=Throughput.PORT, help="set TCP and UDP port")
+parser.add_argument('--bufsize', type=int, default=128*1024, help="set TCP buffer size in bytes")
+parser.add_argument('--maxduration', type=float, default=60.0, help="set maximum seconds of a download stream")
+parser.add_argument('-v', '--verbose', action="store_true", help="print a line per stream")
+args = parser.parse_args()
+
+tcp = Tcp_server((args.bind, args.port), args.bufsize, args.maxduration, args.verbose)
+threading.Thread(target=tcp.serve_forever, daemon=True).start()
+udp = Udp_reflector((args.bind, args.port), args.verbose)
+try:
+	udp.serve_forever()
+except KeyboardInterrupt:
+	pass
+finally:
+	tcp.shutdown()
+	tcp.server_close()
+sys.exit(0)
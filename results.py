@@ -0,0 +1,39 @@
+#!/usr/bin/python3
+
+import sys
+import json
+import argparse
+import datetime
+from common import *
+
+###############################################################################
+#	parse_date
+###############################################################################
+def parse_date(s):
+	return datetime.datetime.fromisoformat(s).timestamp()
+
+###############################################################################
+parser = argparse.ArgumentParser(description='Query test results')
+parser.add_argument('-d', '--database', type=str, default=None, help="set results database (default: results.path)")
+parser.add_argument('-s', '--serial', type=str, default=None, help="select board serial")
+parser.add_argument('-t', '--test', type=str, default=None, help="select test")
+parser.add_argument('--since', type=parse_date, default=None, help="select records from date (ISO 8601)")
+parser.add_argument('--until', type=parse_date, default=None, help="select records before date (ISO 8601)")
+parser.add_argument('--summary', action="store_true", help="print runs, failures and durations per test")
+parser.add_argument('--inf', action="store_true", help="export in inf.txt format")
+args = parser.parse_args()
+
+if args.database == None:
+	with open('config.json') as f:
+		args.database = json.load(f)['results']['path']
+
+store = Results_store(args.database)
+if args.summary:
+	print(json.dumps(store.summary(args.serial, args.test, args.since, args.until), indent=1))
+else:
+	for r in store.query(args.serial, args.test, args.since, args.until):
+		if args.inf:
+			for name in r['info']:
+				sys.stdout.write('{}_{} {}\n'.format(r['test'], name, r['info'][name]))
+		else:
+			sys.stdout.write(json.dumps(r) + '\n')
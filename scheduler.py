@@ -1,40 +1,417 @@
 #!/usr/bin/python3
 
 import os
+import math
+import bisect
 import sys
 import subprocess
 import time
 import argparse
-import tempfile
+import importlib
+import traceback
+import threading
+import json
+import csv
+import signal
+from common import Sysfs, get_tempdir, load_cached, load_json_precompiled, Log_writer, Test_basic, Test_timeout, Results_store, get_board_serial
 
 test_list = ['usb', 'touch', 'ethernet', 'datetime', 'can']
+# run only when named, not part of 'all'
+extra_test_list = ['probe']
+
+###############################################################################
+#	class P2_quantile
+###############################################################################
+class P2_quantile:
+	# P-square estimator (Jain & Chlamtac): five markers, O(1) memory
+	# exact up to EXACT samples, P-square is too coarse for short soaks
+	EXACT = 100
+
+	def __init__(self, p):
+		self.p = p
+		self.count = 0
+		self.samples = []
+		self.q = None
+		self.n = None
+		self.np = None
+		self.dn = [0, p / 2, p, (1 + p) / 2, 1]
+
+	def start_markers(self):
+		# markers at the desired positions in the sorted buffer
+		last = len(self.samples) - 1
+		self.np = [0, last * self.p / 2, last * self.p, last * (1 + self.p) / 2, last]
+		self.n = [int(round(x)) for x in self.np]
+		# positions must stay strictly increasing
+		for i in range(1, 4):
+			self.n[i] = min(max(self.n[i], self.n[i - 1] + 1), last - 4 + i)
+		self.q = [self.samples[i] for i in self.n]
+		self.samples = None
+
+	def add(self, x):
+		self.count += 1
+		if self.count <= P2_quantile.EXACT:
+			bisect.insort(self.samples, x)
+			return
+		if self.q == None:
+			self.start_markers()
+		q = self.q
+		n = self.n
+		if x < q[0]:
+			q[0] = x
+			k = 0
+		elif x >= q[4]:
+			q[4] = x
+			k = 3
+		else:
+			k = 0
+			while x >= q[k + 1]:
+				k += 1
+		for i in range(k + 1, 5):
+			n[i] += 1
+		for i in range(5):
+			self.np[i] += self.dn[i]
+		for i in range(1, 4):
+			d = self.np[i] - n[i]
+			if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+				d = 1 if d > 0 else -1
+				h = self.parabolic(i, d)
+				if not q[i - 1] < h < q[i + 1]:
+					h = q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+				q[i] = h
+				n[i] += d
+
+	def parabolic(self, i, d):
+		q = self.q
+		n = self.n
+		return q[i] + d / (n[i + 1] - n[i - 1]) * ((n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i]) + (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+
+	def value(self):
+		if self.count == 0:
+			return None
+		if self.q == None:
+			# nearest rank
+			return self.samples[max(math.ceil(self.p * self.count) - 1, 0)]
+		return self.q[2]
+
+###############################################################################
+#	class Test_stats
+###############################################################################
+class Test_stats:
+	def __init__(self, name):
+		self.name = name
+		self.runs = 0
+		self.passed = 0
+		self.flips = 0
+		self.last = None
+		self.total = 0.0
+		self.max = 0.0
+		self.quantiles = [P2_quantile(.5), P2_quantile(.95), P2_quantile(.99)]
+
+	def add(self, ok, duration):
+		self.runs += 1
+		if ok:
+			self.passed += 1
+		if self.last != None and self.last != ok:
+			self.flips += 1
+		self.last = ok
+		self.total += duration
+		self.max = max(self.max, duration)
+		for q in self.quantiles:
+			q.add(duration)
+
+	def summary(self):
+		return {
+			'test': self.name,
+			'runs': self.runs,
+			'passed': self.passed,
+			'failed': self.runs - self.passed,
+			'pass_rate': round(100.0 * self.passed / self.runs, 2),
+			'mean': round(self.total / self.runs, 3),
+			'p50': round(self.quantiles[0].value(), 3),
+			'p95': round(self.quantiles[1].value(), 3),
+			'p99': round(self.quantiles[2].value(), 3),
+			'max': round(self.max, 3),
+			'flips': self.flips,
+			'flaky': self.flips > 0
+		}
 
 ###############################################################################
 #	class Scheduler
 ###############################################################################
 class Scheduler:
-	def __init__(self, tests, count, nostop):
+	TIMEOUT = 124
+
+	def __init__(self, tests, count, nostop, mode, jobs, trace, summary, order):
 		self.tests = tests
 		self.count = count
 		self.nostop = nostop
+		self.mode = mode
+		self.jobs = jobs
 		self.test_failed = dict()
+		self.modules = dict()
+		self.cond = threading.Condition()
+		self.trace = trace
+		self.trace_events = []
+		self.summary = summary
+		self.stats = dict()
+		self.order = order
+		self.config = load_cached('config.json', load_json_precompiled)
+		self.printk = Sysfs.read_str('/proc/sys/kernel/printk')
 
-	def start_test(self, i, n, name):
-		if (name == 'all'):
-			for t in test_list:
-				self.start_test(i, n, t)
+	def load_test(self, name):
+		if name not in self.modules:
+			self.modules[name] = importlib.import_module('test_%s' % name)
+		return self.modules[name]
+
+	def test_args(self, i):
+		argv = ['--iteration', str(i)]
+		if self.trace != None:
+			argv += ['--savetrace', 'yes']
+		return argv
+
+	def collect_trace(self, name):
+		if self.trace == None:
+			return
+		path = Test_basic.trace_path(name)
+		try:
+			with open(path) as f:
+				events = json.load(f)['traceEvents']
+			os.remove(path)
+		except (OSError, ValueError):
+			return
+		for e in events:
+			e['pid'] = 1
+			e['tid'] = (test_list + extra_test_list).index(name) + 1
+		self.trace_events.extend(events)
+
+	def write_trace(self):
+		events = [{ 'name': 'process_name', 'ph': 'M', 'pid': 1, 'tid': 0, 'args': { 'name': get_board_serial() } }]
+		for name in test_list + extra_test_list:
+			events.append({ 'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': (test_list + extra_test_list).index(name) + 1, 'args': { 'name': name } })
+		with open(self.trace, 'w') as f:
+			json.dump({ 'traceEvents': events + self.trace_events, 'displayTimeUnit': 'ms' }, f)
+
+	def test_timeout(self, name, deadline):
+		timeout = self.config['scheduler']['timeout'].get(name, self.config['scheduler']['timeout']['default'])
+		if deadline != None:
+			remaining = max(deadline - time.perf_counter(), 0)
+			if timeout == 0 or remaining < timeout:
+				timeout = remaining
+		if timeout == 0 and deadline == None:
+			return None
+		return timeout
+
+	def run_process(self, cmd, timeout, capture):
+		if capture:
+			p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, start_new_session=True)
+		else:
+			p = subprocess.Popen(cmd, start_new_session=True)
+		try:
+			output, err = p.communicate(timeout=timeout)
+			return p.returncode, output
+		except subprocess.TimeoutExpired:
+			# kill the whole group, with children such as ntpd or udhcpc
+			os.killpg(p.pid, signal.SIGKILL)
+			output, err = p.communicate()
+			return Scheduler.TIMEOUT, output
+		except BaseException:
+			os.killpg(p.pid, signal.SIGKILL)
+			p.wait()
+			raise
+
+	def run_test(self, name, i, timeout):
+		argv = self.test_args(i)
+		Test_basic.last_result = None
+		if self.mode == 'subprocess':
+			ret, output = self.run_process(['python3', 'test_%s.py' % name] + argv, timeout, False)
+			return ret
+		if timeout != None:
+			signal.signal(signal.SIGALRM, Test_timeout.handler)
+			signal.setitimer(signal.ITIMER_REAL, max(timeout, .001))
+		try:
+			ret = self.load_test(name).run(argv)
+			if timeout != None:
+				# disarm inside the try, an alarm right after run() is still caught
+				remaining, interval = signal.setitimer(signal.ITIMER_REAL, 0)
+				if remaining == 0:
+					# expired, the test caught Test_timeout and reported it
+					return Scheduler.TIMEOUT
+			return ret
+		except Test_timeout:
+			return Scheduler.TIMEOUT
+		except SystemExit as e:
+			if e.code == None:
+				return 0
+			if isinstance(e.code, int):
+				return e.code
+			return -1
+		except Exception:
+			Log_writer.get().flush()
+			traceback.print_exc()
+			return -1
+		finally:
+			if timeout != None:
+				signal.setitimer(signal.ITIMER_REAL, 0)
+			Log_writer.get().flush()
+
+	def start_test(self, i, n, name, deadline):
+		print('------------------------------')
+		print(' %d/%d - %s' % (i, n, name))
+		print('------------------------------')
+		timeout = self.test_timeout(name, deadline)
+		if timeout == 0:
+			ret = Scheduler.TIMEOUT
+			duration = None
 		else:
+			start = time.perf_counter()
+			ret = self.run_test(name, i, timeout)
+			duration = time.perf_counter() - start
+			self.collect_trace(name)
+		if not self.check_result(name, ret, duration, i) and not self.nostop:
+			raise Scheduler_error(2)
+
+	def record_timeout(self, name, duration, i):
+		if duration == None:
+			print('scheduler.py: %s skipped, time budget exhausted' % name)
+			return
+		print('scheduler.py: %s killed after %0.3f s' % (name, duration))
+		if Test_basic.last_result != None and Test_basic.last_result['code'] == 'TIMEOUT':
+			# in-process, finalize() ran and the result is already saved
+			return
+		if self.jobs == 1 and self.printk != None:
+			# the test had no chance to restore it
+			Sysfs.write_str('/proc/sys/kernel/printk', self.printk)
+		if self.config['saveres'] == 'yes':
+			store = Results_store(self.config['results']['path'])
+			store.add(get_board_serial(), name, i, time.time() - duration, duration, 'TIMEOUT', 'TIMEOUT', {})
+
+	def check_result(self, name, ret, duration, i):
+		if ret == Scheduler.TIMEOUT:
+			self.record_timeout(name, duration, i)
+		if duration != None:
+			if name not in self.stats:
+				self.stats[name] = Test_stats(name)
+			self.stats[name].add(ret == 0, duration)
+		if ret != 0:
+			if name in self.test_failed:
+				self.test_failed[name] += 1
+			else:
+				self.test_failed[name] = 1
+			return False
+		return True
+
+	def expand_tests(self):
+		tests = []
+		for t in self.tests:
+			if t == 'all':
+				tests.extend(test_list)
+			else:
+				tests.append(t)
+		return tests
+
+	def order_tests(self, tests):
+		if self.order != 'risk':
+			return tests
+		history = dict()
+		if self.config['saveres'] == 'yes' and os.path.exists(self.config['results']['path']):
+			for name, r in Results_store(self.config['results']['path']).summary().items():
+				history[name] = (r['runs'], r['failed'], r['avg_duration'])
+		for name in self.stats:
+			if name not in history:
+				st = self.stats[name]
+				history[name] = (st.runs, st.runs - st.passed, st.total / st.runs)
+		def risk(name):
+			runs, failed, duration = history.get(name, (0, 0, 1.0))
+			# Laplace smoothing, unknown tests start at 50%
+			return -((failed + 1.0) / (runs + 2.0)) / max(duration or 1.0, .001)
+		return sorted(tests, key=risk)
+
+	def run_captured(self, name, i, timeout):
+		start = time.perf_counter()
+		ret, output = self.run_process(['python3', 'test_%s.py' % name, '--quiet', 'no'] + self.test_args(i), timeout, True)
+		return ret, output.decode('utf-8', 'replace'), time.perf_counter() - start
+
+	def next_job(self, state):
+		for k in state['pending']:
+			if state['locked'].isdisjoint(state['resources'][k]):
+				state['pending'].remove(k)
+				state['locked'].update(state['resources'][k])
+				return k
+		return None
+
+	def worker(self, state):
+		while True:
+			with self.cond:
+				k = None
+				while k == None:
+					if state['stop'] or len(state['pending']) == 0:
+						return
+					k = self.next_job(state)
+					if k == None:
+						self.cond.wait()
+			timeout = self.test_timeout(state['tests'][k], state['deadline'])
+			try:
+				if timeout == 0:
+					result = (Scheduler.TIMEOUT, '', None)
+				else:
+					result = self.run_captured(state['tests'][k], state['i'], timeout)
+			except OSError as e:
+				result = (-1, 'scheduler.py: %s\n' % e, 0.0)
+			state['done'][k] = result
+			with self.cond:
+				state['locked'].difference_update(state['resources'][k])
+				self.collect_trace(state['tests'][k])
+				self.flush_output(state)
+				self.cond.notify_all()
+
+	def flush_output(self, state):
+		while state['next'] in state['done']:
+			k = state['next']
+			name = state['tests'][k]
+			ret, output, duration = state['done'][k]
 			print('------------------------------')
-			print(' %d/%d - %s' % (i, n, name))
+			print(' %d/%d - %s' % (state['i'], self.count, name))
 			print('------------------------------')
-			ret = subprocess.run(['python3', 'test_%s.py' % name])
-			if ret.returncode != 0:
-				if name in self.test_failed:
-					self.test_failed[name] += 1
-				else:
-					self.test_failed[name] = 1
-				if not args.nostop:
-					raise Scheduler_error(2)
+			sys.stdout.write(output)
+			sys.stdout.flush()
+			if not self.check_result(name, ret, duration, state['i']) and not self.nostop:
+				state['stop'] = True
+				state['failed'] = True
+			state['next'] += 1
+
+	def start_parallel(self, i, tests, deadline):
+		state = {
+			'i': i,
+			'deadline': deadline,
+			'tests': tests,
+			'resources': [set(self.load_test(t).resources) for t in tests],
+			'pending': list(range(len(tests))),
+			'locked': set(),
+			'done': dict(),
+			'next': 0,
+			'stop': False,
+			'failed': False
+		}
+		workers = [threading.Thread(target=self.worker, args=(state,)) for j in range(self.jobs)]
+		for w in workers:
+			w.start()
+		for w in workers:
+			w.join()
+		with self.cond:
+			state['stop'] = False
+			for k in sorted(state['done']):
+				if k >= state['next']:
+					state['next'] = k
+					self.flush_output(state)
+		if state['failed']:
+			raise Scheduler_error(2)
+
+	def quiet_kernel(self):
+		if self.config['quiet'] != 'yes':
+			return None
+		printk_backup = Sysfs.read_str('/proc/sys/kernel/printk')
+		Sysfs.write_int('/proc/sys/kernel/printk', 0)
+		return printk_backup
 
 	def start(self):
 		if self.tests == None:
@@ -49,14 +426,41 @@ class Scheduler:
 					full_test = False
 					break
 
-		inf_path = tempfile.gettempdir() + '/inf.txt'
+		inf_path = get_tempdir() + '/inf.txt'
 		if os.path.exists(inf_path):
 			os.remove(inf_path)
 
-		for i in range(0, self.count):
-			for t in self.tests:
-				self.start_test(i+1, self.count, t)
-			self.show_report(i+1)
+		try:
+			self.run_iterations()
+		finally:
+			if self.trace != None:
+				self.write_trace()
+			if len(self.stats) > 0:
+				self.show_summary()
+			if self.summary != None:
+				self.write_summary()
+
+	def get_deadline(self):
+		if self.config['scheduler']['budget'] > 0:
+			return time.perf_counter() + self.config['scheduler']['budget']
+		return None
+
+	def run_iterations(self):
+		if self.jobs > 1:
+			printk_backup = self.quiet_kernel()
+			try:
+				for i in range(0, self.count):
+					self.start_parallel(i+1, self.order_tests(self.expand_tests()), self.get_deadline())
+					self.show_report(i+1)
+			finally:
+				if printk_backup != None:
+					Sysfs.write_str('/proc/sys/kernel/printk', printk_backup)
+		else:
+			for i in range(0, self.count):
+				deadline = self.get_deadline()
+				for t in self.order_tests(self.expand_tests()):
+					self.start_test(i+1, self.count, t, deadline)
+				self.show_report(i+1)
 
 	def show_report(self, i):
 		print('------------------------------')
@@ -64,6 +468,27 @@ class Scheduler:
 		print('------------------------------')
 		print('Tests failed: %s' % scheduler.test_failed)
 
+	def get_summary(self):
+		return [self.stats[name].summary() for name in sorted(self.stats)]
+
+	def show_summary(self):
+		print('------------------------------')
+		print('   Summary')
+		print('------------------------------')
+		print('{:10} {:>6} {:>7} {:>8} {:>8} {:>8} {:>8} {:>6}'.format('test', 'runs', 'pass%', 'p50', 'p95', 'p99', 'max', 'flips'))
+		for r in self.get_summary():
+			print('{:10} {:>6} {:>7.2f} {:>8.3f} {:>8.3f} {:>8.3f} {:>8.3f} {:>6}{}'.format(r['test'], r['runs'], r['pass_rate'], r['p50'], r['p95'], r['p99'], r['max'], r['flips'], ' FLAKY' if r['flaky'] else ''))
+
+	def write_summary(self):
+		summary = self.get_summary()
+		with open(self.summary, 'w') as f:
+			if self.summary.endswith('.csv'):
+				w = csv.DictWriter(f, fieldnames=['test', 'runs', 'passed', 'failed', 'pass_rate', 'mean', 'p50', 'p95', 'p99', 'max', 'flips', 'flaky'])
+				w.writeheader()
+				w.writerows(summary)
+			else:
+				json.dump(summary, f, indent=1)
+
 ###############################################################################
 #	class Scheduler_error
 ###############################################################################
@@ -72,12 +497,17 @@ class Scheduler_error(Exception):
 		self.code = code
 
 ###############################################################################
-arg_test_list = list(test_list)
+arg_test_list = test_list + extra_test_list
 arg_test_list.append('all')
 
 parser = argparse.ArgumentParser(description='Test scheduler')
 parser.add_argument('-c', '--count', type=int, default=1, help="set number of iterations")
 parser.add_argument('--nostop', action="store_true", help="continue on error")
+parser.add_argument('-m', '--mode', type=str, choices=['inprocess', 'subprocess'], default='inprocess', help="run tests in the scheduler process or one process per test")
+parser.add_argument('-j', '--jobs', type=int, default=1, help="run up to JOBS tests at once, in separate processes, on non-conflicting resources")
+parser.add_argument('--trace', type=str, default=None, help="merge the phases of all tests in a Chrome trace file")
+parser.add_argument('--summary', type=str, default=None, help="write per-test statistics to a JSON (or .csv) file")
+parser.add_argument('--order', type=str, choices=['list', 'risk'], default='list', help="run tests in list order or by historical failure rate per second")
 parser.add_argument('tests', type=str, choices=arg_test_list, nargs='*', help='tests list')
 args = parser.parse_args()
 
@@ -85,7 +515,7 @@ try:
 	if os.getuid() != 0:
 		raise Scheduler_error(1)
 
-	scheduler = Scheduler(args.tests, args.count, args.nostop)
+	scheduler = Scheduler(args.tests, args.count, args.nostop, args.mode, args.jobs, args.trace, args.summary, args.order)
 	scheduler.start()
 
 except Scheduler_error as e:
@@ -0,0 +1,103 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import time
+import select
+import argparse
+import statistics
+import subprocess
+
+###############################################################################
+#	class Startup_bench
+###############################################################################
+class Startup_bench:
+	def __init__(self, python, args, timeout):
+		self.python = python
+		self.args = args
+		self.timeout = timeout
+
+	def first_line(self, name):
+		# interpreter start to the first line printed by the test, and to its exit
+		start = time.perf_counter()
+		deadline = start + self.timeout
+		p = subprocess.Popen([self.python, 'test_%s.py' % name] + self.args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+		fd = p.stdout.fileno()
+		data = b''
+		first = None
+		try:
+			# raw reads under the deadline, a hung test must not block here
+			while first == None:
+				remaining = deadline - time.perf_counter()
+				if remaining <= 0:
+					raise subprocess.TimeoutExpired(p.args, self.timeout)
+				readable, writable, exceptional = select.select([fd], [], [], remaining)
+				if len(readable) == 0:
+					continue
+				r = os.read(fd, 4096)
+				if not r:
+					break
+				data += r
+				if b'\n' in data:
+					first = time.perf_counter() - start
+			p.communicate(timeout=max(deadline - time.perf_counter(), 0))
+		except subprocess.TimeoutExpired:
+			p.kill()
+			p.communicate()
+		total = time.perf_counter() - start
+		return first, total
+
+	def import_times(self, name):
+		# -X importtime on stderr: self [us] | cumulative | package, top level only
+		try:
+			p = subprocess.run([self.python, '-X', 'importtime', '-c', 'import test_%s' % name], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=self.timeout)
+		except subprocess.TimeoutExpired:
+			return []
+		modules = []
+		for line in p.stderr.decode('utf-8', 'replace').splitlines():
+			fields = line.split('|')
+			if len(fields) != 3 or not fields[0].startswith('import time:') or fields[2].startswith('  '):
+				continue
+			try:
+				modules.append((int(fields[1]), fields[2].strip()))
+			except ValueError:
+				pass
+		return sorted(modules, reverse=True)
+
+###############################################################################
+parser = argparse.ArgumentParser(description='Measure test startup latency', epilog='arguments after -- are passed to every test')
+parser.add_argument('-n', '--count', type=int, default=5, help="set runs per test")
+parser.add_argument('--python', type=str, default=sys.executable, help="set interpreter")
+parser.add_argument('--timeout', type=float, default=60.0, help="set seconds before a run is killed")
+parser.add_argument('--importtime', type=int, default=0, help="show the IMPORTTIME slowest top-level imports per test")
+parser.add_argument('tests', nargs='*', help="tests to measure (default: all test_*.py)")
+argv = sys.argv[1:]
+test_args = []
+if '--' in argv:
+	test_args = argv[argv.index('--') + 1:]
+	argv = argv[:argv.index('--')]
+args = parser.parse_args(argv)
+
+tests = args.tests
+if len(tests) == 0:
+	tests = sorted([f[5:-3] for f in os.listdir('.') if f.startswith('test_') and f.endswith('.py')])
+
+bench = Startup_bench(args.python, test_args, args.timeout)
+print('{:12} {:>10} {:>10} {:>10} {:>10}'.format('test', 'first min', 'first p50', 'total p50', 'imports'))
+for name in tests:
+	firsts = []
+	totals = []
+	for i in range(args.count):
+		first, total = bench.first_line(name)
+		if first != None:
+			firsts.append(first)
+		totals.append(total)
+	modules = bench.import_times(name)
+	if len(firsts) > 0:
+		first_min = '{:0.1f}'.format(min(firsts) * 1000.0)
+		first_p50 = '{:0.1f}'.format(statistics.median(firsts) * 1000.0)
+	else:
+		first_min = first_p50 = '-'
+	print('{:12} {:>10} {:>10} {:>10.1f} {:>10.1f}'.format(name, first_min, first_p50, statistics.median(totals) * 1000.0, sum([m[0] for m in modules]) / 1000.0))
+	for us, module in modules[:args.importtime]:
+		print('    {:28} {:8.1f} ms'.format(module, us / 1000.0))
@@ -9,92 +9,349 @@ import select
 import sys
 import struct
 import threading
+import selectors
+import errno
 from common import *
 
+resources = [c['name'] for c in load_cached('config.json', load_json_precompiled)['can']['interfaces']]
+
+###############################################################################
+#	class Can_echo
+###############################################################################
+class Can_echo(threading.Thread):
+	def __init__(self, interface, ids):
+		threading.Thread.__init__(self)
+		# a timed out test never joins it, it must not keep the scheduler alive
+		self.daemon = True
+		self.sock = socket.socket(socket.PF_CAN, socket.SOCK_RAW, socket.CAN_RAW)
+		rfilter = b''.join([struct.pack('=II', i, socket.CAN_SFF_MASK) for i in ids])
+		self.sock.setsockopt(socket.SOL_CAN_RAW, socket.CAN_RAW_FILTER, rfilter)
+		self.sock.bind((interface,))
+		self.running = True
+		self.ready = threading.Event()
+
+	def run(self):
+		self.ready.set()
+		while self.running:
+			readable, writable, exceptional = select.select([self.sock], [], [], .1)
+			if len(readable) == 0:
+				continue
+			can_id, length, data = struct.unpack('<IB3x8s', self.sock.recv(16))
+			try:
+				self.sock.send(struct.pack('<IB3x8s', can_id + 1, length, data))
+			except OSError:
+				# tx queue full, the frame is counted as lost
+				pass
+
+	def stop(self):
+		self.running = False
+		self.join()
+		self.sock.close()
+
+###############################################################################
+#	class Can_port
+###############################################################################
+class Can_port:
+	# sockets kept open between runs of a long-lived process (testd.py)
+	keep_open = False
+	pool = dict()
+
+	def __init__(self, name, can_id, msg):
+		self.name = name
+		self.can_id = can_id
+		self.msg = msg
+		self.sock = None
+		self.tx_time = None
+		self.rtt = None
+		self.error = None
+		self.mismatch = False
+
+	def open(self, rx_id=None):
+		self.key = (self.name, rx_id)
+		if self.key in Can_port.pool:
+			self.sock = Can_port.pool.pop(self.key)
+			self.drain()
+			return
+		self.sock = socket.socket(socket.PF_CAN, socket.SOCK_RAW, socket.CAN_RAW)
+		if rx_id != None:
+			self.sock.setsockopt(socket.SOL_CAN_RAW, socket.CAN_RAW_FILTER, struct.pack('=II', rx_id, socket.CAN_SFF_MASK))
+		try:
+			self.sock.bind((self.name,))
+		except OSError:
+			self.sock.close()
+			self.sock = None
+			raise
+
+	def drain(self):
+		# drop frames received since the previous run
+		self.sock.setblocking(False)
+		try:
+			while True:
+				self.sock.recv(16)
+		except (BlockingIOError, InterruptedError):
+			pass
+		self.sock.setblocking(True)
+
+	def close(self):
+		if self.sock != None:
+			if Can_port.keep_open and self.key not in Can_port.pool:
+				Can_port.pool[self.key] = self.sock
+			else:
+				self.sock.close()
+			self.sock = None
+
 ###############################################################################
 #	class Test_can
 ###############################################################################
 class Test_can(Test_basic):
+	application_stopped = False
+
 	def __init__(self):
 		Test_basic.__init__(self, 'can')
 		self.err_dict['OS_ERROR'] = 'OS Error \'%s\''
-		self.err_dict['TEST_CAN_FAIL'] = 'Test "CAN" failed'
+		self.err_dict['TEST_CAN_FAIL'] = 'Test "CAN" failed on interface \'%s\''
 		self.err_dict['NOT_BIND_IF'] = 'Could not bind to interface \'%s\''
 		self.err_dict['TIMEOUT'] = 'Not receive package on interface \'%s\''
-		self.rx_error = None
-		self.sock = None
-		self.interface = None
+		self.err_dict['STRESS_FAILED'] = 'CAN stress test lost %s frames'
+		self.ports = []
+		self.echoes = []
 
 	def initialize(self):
 		Test_basic.initialize(self)
 
 	def finalize(self):
-		try:
-			Test_basic.finalize(self)
-		except Test_error as e:
-			sys.exit(-1)
+		for e in self.echoes:
+			e.stop()
+		self.echoes = []
+		for p in self.ports:
+			p.close()
+		self.ports = []
+		Test_basic.finalize(self)
 
 	def stop_application(self):
+		if Test_can.application_stopped:
+			return
 		subprocess.run(['systemctl', 'stop', 'gt5'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+		Test_can.application_stopped = Can_port.keep_open
 
-	def tx(self, a_id, a_msg):
+	def start_echo(self, interface, ids):
 		try:
-			can_pkt = struct.pack('<IB3x8s', a_id, len(a_msg), a_msg)
-			self.sock.send(can_pkt)
-		except OSError as e:
-			raise Test_error(self, 'OS_ERROR', str(e))
+			echo = Can_echo(interface, ids)
+		except OSError:
+			raise Test_error(self, 'NOT_BIND_IF', interface)
+		self.echoes.append(echo)
+		echo.start()
+		echo.ready.wait()
 
-	def rx(a_id, a_msg, t):
+	def open_port(self, port, rx_id=None):
+		self.ports.append(port)
 		try:
-			inputs = [ t.sock ]
-			outputs = []
-			readable, writable, exceptional = select.select(inputs, outputs, inputs, 10)
-			s = readable[0]
-			can_pkt = s.recv(16)
-			can_id, length, data = struct.unpack('<IB3x8s', can_pkt)
-			can_id &= socket.CAN_EFF_MASK
-			msg = data[:length]
-			if can_id == (a_id+1) and msg == a_msg:
-				pass
-			else:
-				t.rx_error = Test_error(t, 'TEST_CAN_FAIL')
-		except IndexError:
-			t.rx_error = Test_error(t, 'TIMEOUT', t.interface)
-		except OSError as e:
-				t.rx_error = Test_error(t, 'OS_ERROR', str(e))
-
-	def test(self, interface, can_id, msg):
-		self.interface = interface
-		self.sock = socket.socket(socket.PF_CAN, socket.SOCK_RAW, socket.CAN_RAW)
-		try:
-			self.sock.bind((interface,))
+			port.open(rx_id)
 		except OSError:
-			raise Test_error(self, 'NOT_BIND_IF', interface)
-		t = threading.Thread(target=Test_can.rx, args=(can_id, msg, self))
-		t.start()
-		time.sleep(.1)
-		self.tx(can_id, msg)
-		t.join()
+			raise Test_error(self, 'NOT_BIND_IF', port.name)
+
+	def test(self, ports, timeout):
+		sel = selectors.DefaultSelector()
+		for p in ports:
+			# only the reply ID, other ports and bus traffic are filtered out
+			self.open_port(p, p.can_id + 1)
+			sel.register(p.sock, selectors.EVENT_READ, p)
+
+		start = time.perf_counter()
+		for p in ports:
+			try:
+				p.tx_time = time.perf_counter()
+				p.sock.send(struct.pack('<IB3x8s', p.can_id, len(p.msg), p.msg))
+			except OSError as e:
+				p.error = Test_error(self, 'OS_ERROR', str(e))
+				sel.unregister(p.sock)
+
+		deadline = start + timeout
+		while len(sel.get_map()) > 0:
+			events = sel.select(deadline - time.perf_counter())
+			if len(events) == 0:
+				break
+			for key, mask in events:
+				p = key.data
+				try:
+					can_pkt = p.sock.recv(16)
+				except OSError as e:
+					p.error = Test_error(self, 'OS_ERROR', str(e))
+					sel.unregister(p.sock)
+					continue
+				can_id, length, data = struct.unpack('<IB3x8s', can_pkt)
+				if (can_id & socket.CAN_EFF_MASK) != p.can_id + 1 or data[:length] != p.msg:
+					# keep waiting for the right frame until the deadline
+					p.mismatch = True
+					continue
+				p.rtt = time.perf_counter() - p.tx_time
+				sel.unregister(p.sock)
+		for key in list(sel.get_map().values()):
+			if key.data.mismatch:
+				key.data.error = Test_error(self, 'TEST_CAN_FAIL', key.data.name)
+			else:
+				key.data.error = Test_error(self, 'TIMEOUT', key.data.name)
+		sel.close()
+
+		for p in ports:
+			if p.error == None:
+				self.info('%s_rtt' % p.name, '{:0.3f}'.format(p.rtt * 1000.0))
+			else:
+				self.warning('Interface \'%s\': %s' % (p.name, p.error.code))
+		for p in ports:
+			if p.error != None:
+				raise p.error
+		return self.success()
+
+	def stress(self, interface, can_id, pattern, frames, rate, window, timeout, max_lost):
+		port = Can_port(interface, can_id, pattern)
+		self.open_port(port, can_id + 1)
+		sock = port.sock
+		sock.setblocking(False)
+		period = 0.0
+		if rate > 0:
+			period = 1.0 / rate
+		inflight = dict()
+		histogram = dict()
+		sent = 0
+		received = 0
+		lost = 0
+		out_of_order = 0
+		unexpected = 0
+		last_seq = -1
+		rtt_sum = 0
+		start = time.perf_counter()
+		end = start
+		next_send = start
+		while True:
+			now = time.perf_counter()
+			while True:
+				try:
+					can_pkt = sock.recv(16)
+				except BlockingIOError:
+					break
+				except OSError as e:
+					raise Test_error(self, 'OS_ERROR', str(e))
+				now = time.perf_counter()
+				rx_id, length, data = struct.unpack('<IB3x8s', can_pkt)
+				seq = struct.unpack('>I', data[:4])[0]
+				if length != 8 or data[4:] != pattern or seq not in inflight:
+					unexpected += 1
+					continue
+				rtt = int((now - inflight.pop(seq)) * 1000000)
+				rtt_sum += rtt
+				b = max(rtt, 1).bit_length()
+				histogram[b] = histogram.get(b, 0) + 1
+				if seq < last_seq:
+					out_of_order += 1
+				else:
+					last_seq = seq
+				received += 1
+				end = now
+
+			# inflight is ordered by seq, so expired frames are at the front
+			while len(inflight) > 0:
+				seq = next(iter(inflight))
+				if now - inflight[seq] < timeout:
+					break
+				del inflight[seq]
+				lost += 1
 
-		if self.rx_error == None:
-			self.success()
-		else:
-			raise self.rx_error
+			if sent == frames and len(inflight) == 0:
+				break
+
+			blocked = False
+			while sent < frames and now >= next_send and len(inflight) < window:
+				try:
+					sock.send(struct.pack('<IB3x8s', can_id, 8, struct.pack('>I', sent) + pattern))
+				except (BlockingIOError, InterruptedError):
+					blocked = True
+					break
+				except OSError as e:
+					if e.errno != errno.ENOBUFS:
+						raise Test_error(self, 'OS_ERROR', str(e))
+					blocked = True
+					break
+				inflight[sent] = now
+				sent += 1
+				next_send += period
+
+			wait = timeout
+			if len(inflight) > 0:
+				wait = min(wait, inflight[next(iter(inflight))] + timeout - now)
+			if blocked:
+				wait = min(wait, .001)
+			elif sent < frames and len(inflight) < window:
+				wait = min(wait, next_send - now)
+			select.select([sock], [], [], max(wait, 0))
+
+		self.info(interface + '_stress_sent', sent)
+		self.info(interface + '_stress_received', received)
+		self.info(interface + '_stress_lost', lost)
+		self.info(interface + '_stress_out_of_order', out_of_order)
+		self.info(interface + '_stress_unexpected', unexpected)
+		if received > 0:
+			self.info(interface + '_stress_rate', '{:0.1f}'.format(received / max(end - start, 1e-6)))
+			self.info(interface + '_stress_rtt_avg_us', rtt_sum // received)
+		for b in sorted(histogram):
+			self.info('%s_stress_rtt_lt_%dus' % (interface, 1 << b), histogram[b])
+
+		if received == 0:
+			raise Test_error(self, 'TIMEOUT', interface)
+		if lost > max_lost:
+			raise Test_error(self, 'STRESS_FAILED', lost)
 
 ###############################################################################
-try:
-	t = Test_can()
-	
-	t.stop_application()
-
-	parser = argparse.ArgumentParser(description='Test Can')
-	t.add_common_arguments(parser)
-	args = parser.parse_args()
-	t.copy_common_arguments(args)
-	
-	t.initialize()
-
-	t.test('can0', 0x12, b'11223344')
-
-except Test_error as e:
-	e.test.error(e.code, e.value)
+def run(argv=None):
+	t = None
+	try:
+		t = Test_can()
+
+		t.stop_application()
+
+		parser = argparse.ArgumentParser(description='Test Can')
+		t.add_common_arguments(parser)
+		parser.add_argument('-i', '--interface', type=str, nargs='+', help="set CAN interfaces (default: can.interfaces)")
+		parser.add_argument('--echo', type=str, choices=['yes', 'no'], default=t.config['can']['echo'], help="echo frames locally with ID+1 (vcan)")
+		parser.add_argument('--stress', type=str, choices=['yes', 'no'], default=t.config['can']['stress'], help="run the throughput and latency stress test")
+		parser.add_argument('--frames', type=int, default=t.config['can']['stress_frames'], help="set number of stress frames")
+		parser.add_argument('--rate', type=int, default=t.config['can']['stress_rate'], help="set stress frames per second (0 = unlimited)")
+		args = parser.parse_args(argv)
+		t.copy_common_arguments(args)
+
+		ports = []
+		for c in t.config['can']['interfaces']:
+			if args.interface == None or c['name'] in args.interface:
+				ports.append(Can_port(c['name'], c['id'], bytes.fromhex(c['payload'])))
+		if args.interface != None:
+			for name in args.interface:
+				if name not in [p.name for p in ports]:
+					c = t.config['can']['interfaces'][0]
+					ports.append(Can_port(name, c['id'], bytes.fromhex(c['payload'])))
+
+		t.initialize()
+
+		stress_id = t.config['can']['stress_id']
+		if args.echo == 'yes':
+			for p in ports:
+				t.start_echo(p.name, [p.can_id, stress_id])
+
+		if args.stress == 'yes':
+			for p in ports:
+				t.message('Stress %d frames on \'%s\'' % (args.frames, p.name))
+				with t.phase('stress_%s' % p.name):
+					t.stress(p.name, stress_id, bytes.fromhex(t.config['can']['stress_pattern']), args.frames, args.rate, t.config['can']['stress_window'], t.config['can']['stress_timeout'], t.config['can']['stress_max_lost'])
+			return t.success()
+
+		t.message('Test %s' % ', '.join([p.name for p in ports]))
+		return t.test(ports, t.config['can']['timeout'])
+
+	except Test_error as e:
+		return e.test.error(e.code, e.value)
+	except Test_timeout:
+		if t == None:
+			raise
+		return t.timeout()
+
+if __name__ == '__main__':
+	sys.exit(run())
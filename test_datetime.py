@@ -1,10 +1,12 @@
 #!/usr/bin/python3
 
 import os
-import subprocess
+import time
 import argparse
 from common import *
 
+resources = ['eth0']
+
 ###############################################################################
 #	class Test_datetime
 ###############################################################################
@@ -13,60 +15,122 @@ class Test_datetime(Test_basic):
 		Test_basic.__init__(self, 'datetime')
 		self.err_dict['NTP_CLIENT_ERROR'] = 'NTP client error'
 		self.err_dict['STORE_TO_HWCLOCK_FAILED'] = 'Store to hardware clock failed'
+		self.err_dict['RTC_DRIFT'] = 'Hardware clock drift %s ppm'
+		self.rtc = None
 	
 	def initialize(self):
 		Test_basic.initialize(self)
 
 	def finalize(self):
-		try:
-			Test_basic.finalize(self)
-		except Test_error as e:		
-			sys.exit(-1)
+		if self.rtc != None:
+			self.rtc.close()
+			self.rtc = None
+		Test_basic.finalize(self)
+
+	def open_rtc(self):
+		if self.rtc == None:
+			self.rtc = Rtc(self.rtc_path)
+		return self.rtc
 
 	def set_ip_address(self, if_name):
-		return subprocess.run(['udhcpc', '-n', '-i', if_name], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+		return self.acquire_ip_address(if_name) != None
 
 	def ntp_client(self):
-		if subprocess.run(['ntpd', '-n', '-q', '-p', self.peer], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode != 0:
+		c = self.config['datetime']
+		client = Sntp_client(self.peers, c['ntp_samples'], c['ntp_timeout'])
+		results = client.run(self.ntp_deadline)
+		for peer in results:
+			if not isinstance(results[peer], Sntp_sample):
+				self.debug('NTP peer {}: {}'.format(peer, results[peer]))
+		best = client.best()
+		if best == None:
 			raise Test_error(self, 'NTP_CLIENT_ERROR')
+		self.info('ntp_peer', best.peer)
+		self.info('ntp_offset_ms', '{:0.3f}'.format(best.offset * 1000.0))
+		self.info('ntp_delay_ms', '{:0.3f}'.format(best.delay * 1000.0))
+		self.info('ntp_stratum', best.stratum)
+		if self.set_clock:
+			Sntp_client.set_clock(best.offset)
 
 	def hc_to_sys(self):
-		if subprocess.run(['hwclock'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode != 0:
-			self.warning('Read from hardware clock failed')
+		try:
+			rtc_time = self.open_rtc().read_time()
+		except OSError as e:
+			self.warning('Read from hardware clock failed: {}'.format(e))
+			return
+		self.debug('Hardware clock {}'.format(rtc_time))
+		self.info('rtc_offset_s', '{:0.0f}'.format(rtc_time.timestamp() - time.time()))
 
 	def sys_to_hc(self):
-		if subprocess.run(['hwclock', '-w'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode != 0:
+		try:
+			self.open_rtc().set_from_system()
+		except OSError:
 			raise Test_error(self, 'STORE_TO_HWCLOCK_FAILED')
 
-###############################################################################
-try:
-	t = Test_datetime()
-	
-	parser = argparse.ArgumentParser(description='Test Date & Time')
-	t.add_common_arguments(parser)
-	parser.add_argument('--peer', type=str, default=t.config['datetime']['peer'], help="set IP address of NTP server")
-	args = parser.parse_args()
-	t.copy_common_arguments(args)
-	t.peer = args.peer
-
-	t.initialize()
-
-	t.message('Read hardware clock')
-	t.hc_to_sys()
-
-	t.message('Set IP address via dhcp')
-	if not t.set_ip_address('eth0'):
-		raise Test_error(t, 'NO_IP_ADDR')
-
-	t.message('NTP client from %s' % t.peer)
-	t.ntp_client()
-
-	t.message('Write hardware clock')
-	t.sys_to_hc()
-
-	t.success()
-
-except Test_error as e:
-	e.test.error(e.code, e.value)
-
+	def drift(self, window, clock, max_ppm):
+		try:
+			ppm = self.open_rtc().measure_drift(window, clock)
+		except OSError as e:
+			self.warning('Hardware clock drift failed: {}'.format(e))
+			ppm = None
+		if ppm == None:
+			raise Test_error(self, 'RTC_DRIFT', 'not measured')
+		self.info('rtc_drift_ppm', '{:0.1f}'.format(ppm))
+		if abs(ppm) > max_ppm:
+			raise Test_error(self, 'RTC_DRIFT', '{:0.1f}'.format(ppm))
 
+###############################################################################
+def run(argv=None):
+	t = None
+	try:
+		t = Test_datetime()
+
+		parser = argparse.ArgumentParser(description='Test Date & Time')
+		t.add_common_arguments(parser)
+		parser.add_argument('--peer', type=str, action='append', default=None, help="add NTP server ADDRESS[:PORT] (default: datetime.peers)")
+		parser.add_argument('--deadline', type=float, default=t.config['datetime']['ntp_deadline'], help="set maximum seconds for the NTP step")
+		parser.add_argument('--setclock', type=str, choices=['yes', 'no'], default=t.config['datetime']['set_clock'], help="set the system clock from the best peer")
+		parser.add_argument('--rtc', type=str, default=t.config['datetime']['rtc'], help="set RTC device")
+		parser.add_argument('--drift', type=float, default=t.config['datetime']['drift_window'], help="measure RTC drift over DRIFT seconds (0 = off)")
+		args = parser.parse_args(argv)
+		t.copy_common_arguments(args)
+		t.rtc_path = args.rtc
+		t.peers = args.peer if args.peer != None else t.config['datetime']['peers']
+		t.ntp_deadline = args.deadline
+		t.set_clock = (args.setclock == 'yes')
+
+		t.initialize()
+
+		t.message('Read hardware clock')
+		with t.phase('hc_to_sys'):
+			t.hc_to_sys()
+
+		t.message('Set IP address via dhcp')
+		with t.phase('dhcp'):
+			if not t.set_ip_address('eth0'):
+				raise Test_error(t, 'NO_IP_ADDR')
+
+		t.message('NTP client from %s' % ', '.join(t.peers))
+		with t.phase('ntp'):
+			t.ntp_client()
+
+		t.message('Write hardware clock')
+		with t.phase('sys_to_hc'):
+			t.sys_to_hc()
+
+		if args.drift > 0:
+			t.message('Measure hardware clock drift over %g s' % args.drift)
+			with t.phase('rtc_drift'):
+				t.drift(args.drift, t.config['datetime']['drift_clock'], t.config['datetime']['max_drift_ppm'])
+
+		return t.success()
+
+	except Test_error as e:
+		return e.test.error(e.code, e.value)
+	except Test_timeout:
+		if t == None:
+			raise
+		return t.timeout()
+
+if __name__ == '__main__':
+	sys.exit(run())
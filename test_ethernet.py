@@ -1,11 +1,12 @@
 #!/usr/bin/python3
 
 import os
-import subprocess
 import time
 import argparse
 from common import *
 
+resources = ['eth0']
+
 ###############################################################################
 #	class Test_ethernet
 ###############################################################################
@@ -14,69 +15,154 @@ class Test_ethernet(Test_basic):
 		Test_basic.__init__(self, 'ethernet')
 		self.err_dict['IF_NOT_FOUND'] = 'Interface \'%s\' not found'
 		self.err_dict['PING_FAILED'] = 'Ping failed'
+		self.err_dict['THROUGHPUT_FAILED'] = 'Throughput test failed: %s'
+		self.if_info = None
 		
 	def initialize(self):
 		Test_basic.initialize(self)
 
 	def finalize(self):
-		try:
-			Test_basic.finalize(self)
-		except Test_error as e:
-			sys.exit(-1)
+		Test_basic.finalize(self)
 
 	def check_interface(self, if_name):
-		return subprocess.run(['ip', 'address', 'show', if_name], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+		self.if_info = Interface_info.get(if_name, self.config['network']['info_validity'])
+		return self.if_info != None
 
 	def get_mac_address(self, if_name):
-		ret = subprocess.run(['ip', 'address', 'show', if_name], stdout=subprocess.PIPE)
-		mac_address = self.simple_re(ret.stdout.decode('utf-8'), '.*link/ether ([0-9A-Fa-f]{2}:[0-9A-Fa-f]{2}:[0-9A-Fa-f]{2}:[0-9A-Fa-f]{2}:[0-9A-Fa-f]{2}:[0-9A-Fa-f]{2})')
-		return mac_address
+		if self.if_info.mac_address == None:
+			raise Test_error(self, 'IF_NOT_FOUND', if_name)
+		return self.if_info.mac_address
 
 	def get_ip_address(self, if_name):
-		ret = subprocess.run(['ip', 'address', 'show', if_name], stdout=subprocess.PIPE)
-		ip_address = self.simple_re(ret.stdout.decode('utf-8'), '.*inet ([0-9]*\.[0-9]*\.[0-9]*\.[0-9]*)')
+		ip_address = self.if_info.get_ip_address()
+		if ip_address == None:
+			raise Test_error(self, 'NO_IP_ADDR')
 		return ip_address
 
+	def get_link(self, if_name):
+		return self.if_info.speed, self.if_info.duplex
+
 	def set_ip_address(self, if_name):
-		return subprocess.run(['udhcpc', '-n', '-i', if_name], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+		self.if_info = self.acquire_ip_address(if_name, self.if_info)
+		return self.if_info != None
 
 	def ping(self):
-		if subprocess.run(['ping', self.target, '-q', '-c', '3'], stdout=subprocess.DEVNULL).returncode != 0:
+		try:
+			pinger = Pinger(self.target, self.ping_size)
+			try:
+				r = pinger.run(self.ping_count, self.ping_interval, self.ping_deadline, fail_fast=self.ping_fail_fast)
+			finally:
+				pinger.close()
+		except OSError as e:
+			self.warning('Ping %s: %s' % (self.target, e))
 			raise Test_error(self, 'PING_FAILED')
+		self.info('ping_sent', r.sent)
+		self.info('ping_received', r.received())
+		self.info('ping_loss', '{:0.1f}'.format(r.loss()))
+		if r.received() == 0:
+			raise Test_error(self, 'PING_FAILED')
+		self.info('ping_rtt_min', '{:0.3f}'.format(r.min()))
+		self.info('ping_rtt_avg', '{:0.3f}'.format(r.avg()))
+		self.info('ping_rtt_max', '{:0.3f}'.format(r.max()))
+		self.info('ping_rtt_mdev', '{:0.3f}'.format(r.mdev()))
+
+	def throughput(self, host):
+		c = self.config['ethernet']
+		duration = c['throughput_duration']
+		t = Throughput(host, c['reflector_port'])
+		try:
+			tx = t.tcp_send(duration)
+			rx = t.tcp_receive(duration)
+			udp = t.udp(duration, c['udp_rate_Mbps'], c['udp_size'])
+		except OSError as e:
+			self.warning('Throughput %s: %s' % (host, e))
+			raise Test_error(self, 'THROUGHPUT_FAILED', 'no reflector')
+		finally:
+			t.close()
+		self.info('tcp_tx_Mbps', '{:0.1f}'.format(tx.mbps()))
+		self.info('tcp_rx_Mbps', '{:0.1f}'.format(rx.mbps()))
+		self.info('udp_Mbps', '{:0.1f}'.format(udp.mbps()))
+		self.info('udp_loss', '{:0.2f}'.format(udp.loss()))
+		self.info('udp_jitter_ms', '{:0.3f}'.format(udp.jitter * 1000.0))
+		failed = []
+		if min(tx.mbps(), rx.mbps()) < c['min_tcp_Mbps']:
+			failed.append('tcp')
+		if udp.mbps() < c['min_udp_Mbps']:
+			failed.append('udp')
+		if udp.loss() > c['max_udp_loss']:
+			failed.append('udp loss')
+		if udp.jitter * 1000.0 > c['max_udp_jitter_ms']:
+			failed.append('udp jitter')
+		if len(failed) > 0:
+			raise Test_error(self, 'THROUGHPUT_FAILED', ', '.join(failed))
 
 ###############################################################################
-try:
-	t = Test_ethernet()
-
-	parser = argparse.ArgumentParser(description='Test Ethernet')
-	t.add_common_arguments(parser)
-	parser.add_argument('-t', '--target', type=str, default=t.config['ethernet']['target'], help="set target IP address to ping")
-	args = parser.parse_args()
-	t.copy_common_arguments(args)
-	t.target = args.target
-
-	t.initialize()
-
-	t.message('Check interface \'eth0\'')
-	if not t.check_interface('eth0'):
-		raise Test_error(t, 'IF_NOT_FOUND', 'eth0')
-
-	t.message('Set IP address via dhcp')
-	if not t.set_ip_address('eth0'):
-		raise Test_error(t, 'NO_IP_ADDR')
-
-	t.message('Get IP address \'eth0\'')
-	ip_address = t.get_ip_address('eth0')
-	t.message('IP address \'eth0\': %s' % ip_address)
-
-	t.message('Get MAC address \'eth0\'')
-	ip_address = t.get_mac_address('eth0')
-	t.info('MAC_address_eth0', ip_address)
-
-	t.message('Ping %s' % t.target)
-	t.ping()
-
-	t.success()
-
-except Test_error as e:
-	e.test.error(e.code, e.value)
+def run(argv=None):
+	t = None
+	try:
+		t = Test_ethernet()
+
+		parser = argparse.ArgumentParser(description='Test Ethernet')
+		t.add_common_arguments(parser)
+		parser.add_argument('-t', '--target', type=str, default=t.config['ethernet']['target'], help="set target IP address to ping")
+		parser.add_argument('--count', type=int, default=t.config['ethernet']['ping_count'], help="set number of echo requests")
+		parser.add_argument('--interval', type=float, default=t.config['ethernet']['ping_interval'], help="set seconds between echo requests")
+		parser.add_argument('--deadline', type=float, default=t.config['ethernet']['ping_deadline'], help="set maximum seconds for the ping step")
+		parser.add_argument('--size', type=int, default=t.config['ethernet']['ping_size'], help="set echo payload size in bytes")
+		parser.add_argument('--failfast', type=str, choices=['yes', 'no'], default=t.config['ethernet']['ping_failfast'], help="stop at the first echo reply")
+		parser.add_argument('--throughput', type=str, choices=['yes', 'no'], default=t.config['ethernet']['throughput'], help="measure TCP and UDP throughput against reflector.py")
+		parser.add_argument('--reflector', type=str, default=t.config['ethernet']['reflector'], help="set reflector address (default: target)")
+		args = parser.parse_args(argv)
+		t.copy_common_arguments(args)
+		t.target = args.target
+		t.ping_count = args.count
+		t.ping_interval = args.interval
+		t.ping_deadline = args.deadline
+		t.ping_size = args.size
+		t.ping_fail_fast = (args.failfast == 'yes')
+
+		t.initialize()
+
+		t.message('Check interface \'eth0\'')
+		with t.phase('check_interface'):
+			if not t.check_interface('eth0'):
+				raise Test_error(t, 'IF_NOT_FOUND', 'eth0')
+
+		t.message('Set IP address via dhcp')
+		with t.phase('dhcp'):
+			if not t.set_ip_address('eth0'):
+				raise Test_error(t, 'NO_IP_ADDR')
+
+		t.message('Get IP address \'eth0\'')
+		ip_address = t.get_ip_address('eth0')
+		t.message('IP address \'eth0\': %s' % ip_address)
+
+		t.message('Get MAC address \'eth0\'')
+		ip_address = t.get_mac_address('eth0')
+		t.info('MAC_address_eth0', ip_address)
+
+		speed, duplex = t.get_link('eth0')
+		t.info('link_speed_eth0', speed)
+		t.info('link_duplex_eth0', duplex)
+
+		t.message('Ping %s' % t.target)
+		with t.phase('ping'):
+			t.ping()
+
+		if args.throughput == 'yes':
+			reflector = args.reflector if args.reflector != None else t.target
+			t.message('Throughput to %s' % reflector)
+			with t.phase('throughput'):
+				t.throughput(reflector)
+
+		return t.success()
+
+	except Test_error as e:
+		return e.test.error(e.code, e.value)
+	except Test_timeout:
+		if t == None:
+			raise
+		return t.timeout()
+
+if __name__ == '__main__':
+	sys.exit(run())
@@ -0,0 +1,79 @@
+#!/usr/bin/python3
+
+import os
+import time
+import argparse
+from common import *
+
+resources = []
+
+###############################################################################
+#	class Test_probe
+###############################################################################
+class Test_probe(Test_basic):
+	def __init__(self):
+		Test_basic.__init__(self, 'probe')
+		self.err_dict['NO_PROBE'] = 'Probe \'%s\' not found'
+		self.err_dict['PROBE_FAILED'] = 'Probe failed: %s'
+
+	def initialize(self):
+		Test_basic.initialize(self)
+
+	def finalize(self):
+		Test_basic.finalize(self)
+
+	def select(self, names):
+		probes = self.config['probes']
+		if len(names) == 0:
+			return probes
+		selected = []
+		for name in names:
+			p = [p for p in probes if p['name'] == name]
+			if len(p) == 0:
+				raise Test_error(self, 'NO_PROBE', name)
+			selected += p
+		return selected
+
+	def check(self, probes, jobs):
+		failed = []
+		for r in Probe_engine(probes, jobs).run():
+			if r.error != None:
+				self.debug('{}: {}'.format(r.name, r.error))
+			self.message('Probe {} {} ({})'.format(r.name, 'OK' if r.ok else 'FAILED', r.value))
+			self.info(r.name, r.value)
+			if not r.ok:
+				failed.append(r.name)
+		return failed
+
+###############################################################################
+def run(argv=None):
+	t = None
+	try:
+		t = Test_probe()
+
+		parser = argparse.ArgumentParser(description='Run the probes declared in config.json')
+		t.add_common_arguments(parser)
+		parser.add_argument('-p', '--probe', type=str, action='append', default=[], help="run only probe PROBE")
+		parser.add_argument('-j', '--jobs', type=int, default=t.config['probe']['jobs'], help="set number of probes evaluated at once")
+		args = parser.parse_args(argv)
+		t.copy_common_arguments(args)
+
+		t.initialize()
+
+		probes = t.select(args.probe)
+		with t.phase('probes'):
+			failed = t.check(probes, args.jobs)
+		if len(failed) > 0:
+			raise Test_error(t, 'PROBE_FAILED', ', '.join(failed))
+
+		return t.success()
+
+	except Test_error as e:
+		return e.test.error(e.code, e.value)
+	except Test_timeout:
+		if t == None:
+			raise
+		return t.timeout()
+
+if __name__ == '__main__':
+	sys.exit(run())
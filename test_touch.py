@@ -1,15 +1,20 @@
 #!/usr/bin/python3
 
 import os
-import subprocess
+import re
 import time
 import argparse
 from common import *
 
+resources = []
+
 ###############################################################################
 #	class Test_touch
 ###############################################################################
 class Test_touch(Test_basic):
+	# kept between runs in a long-lived process, only new records are read
+	kmsg = None
+
 	def __init__(self):
 		Test_basic.__init__(self, 'touch')
 		self.err_dict['NO_TOUCH'] = 'AR1100 HID-MOUSE not detected'
@@ -18,30 +23,62 @@ class Test_touch(Test_basic):
 		Test_basic.initialize(self)
 
 	def finalize(self):
-		try:
-			Test_basic.finalize(self)
-		except Test_error as e:
-			sys.exit(-1)
+		Test_basic.finalize(self)
 
-	def check_touch(self):
-		return subprocess.run(['sh', '-c', 'dmesg | grep AR1100'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+	def find_touch(self):
+		c = self.config['touch']
+		devices = find_device(c['vid'], c['pid'])
+		if len(devices) > 0:
+			self.debug('Device {}'.format(devices[0]))
+			self.info('source', 'sysfs')
+			return True
+		return False
+
+	def check_touch(self, wait):
+		if self.find_touch():
+			return True
+		if Test_touch.kmsg == None:
+			try:
+				Test_touch.kmsg = Kmsg_reader(self.config['touch']['signatures'])
+			except (OSError, re.error) as e:
+				# no /dev/kmsg or a bad signature, sysfs only
+				self.warning('Kernel log not available: %s' % e)
+				return self.find_touch()
+		# the controller may enumerate late, wait for its kernel message
+		record = Test_touch.kmsg.wait(None, wait)
+		if record != None:
+			self.debug('[{:0.6f}] {}'.format(record.ts, record.text))
+			self.info('source', 'kmsg')
+			return True
+		return self.find_touch()
 
 ###############################################################################
-try:
-	t = Test_touch()
+def run(argv=None):
+	t = None
+	try:
+		t = Test_touch()
+
+		parser = argparse.ArgumentParser(description='Test touch')
+		t.add_common_arguments(parser)
+		parser.add_argument('--wait', type=float, default=t.config['touch']['wait'], help="set seconds to wait for the controller to enumerate")
+		args = parser.parse_args(argv)
+		t.copy_common_arguments(args)
 
-	parser = argparse.ArgumentParser(description='Test touch')
-	t.add_common_arguments(parser)
-	args = parser.parse_args()
-	t.copy_common_arguments(args)
+		t.initialize()
 
-	t.initialize()
+		t.message('Check touch AR1100 HID-MOUSE')
+		with t.phase('check_touch'):
+			if not t.check_touch(args.wait):
+				raise Test_error(t, 'NO_TOUCH')
 
-	t.message('Check touch AR1100 HID-MOUSE')
-	if not t.check_touch():
-		raise Test_error(t, 'NO_TOUCH')
+		return t.success()
 
-	t.success()
+	except Test_error as e:
+		return e.test.error(e.code, e.value)
+	except Test_timeout:
+		if t == None:
+			raise
+		return t.timeout()
 
-except Test_error as e:
-	e.test.error(e.code, e.value)
+if __name__ == '__main__':
+	sys.exit(run())
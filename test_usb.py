@@ -4,8 +4,112 @@ import os
 import subprocess
 import time
 import argparse
+import concurrent.futures
+import mmap
+import errno
+import random
 from common import *
 
+resources = ['usb']
+
+###############################################################################
+#	class Disk_benchmark
+###############################################################################
+class Disk_benchmark:
+	def __init__(self, path, size, block, random_block, random_reads):
+		self.filename = os.path.join(path, 'bench.tmp')
+		self.size = size - size % block
+		self.block = block
+		self.random_block = random_block
+		self.random_reads = random_reads
+		self.direct = hasattr(os, 'O_DIRECT')
+		# anonymous mappings are page aligned, as O_DIRECT requires
+		self.pattern = (bytes(range(256)) * (block // 256 + 1))[:block]
+		self.wbuf = mmap.mmap(-1, block)
+		self.wbuf[:] = self.pattern
+		self.rbuf = mmap.mmap(-1, block)
+		self.write_mbps = 0.0
+		self.read_mbps = 0.0
+		self.iops = 0.0
+		self.latencies = []
+		self.verified = False
+
+	def close(self):
+		self.wbuf.close()
+		self.rbuf.close()
+		if os.path.exists(self.filename):
+			os.remove(self.filename)
+
+	def open(self, flags):
+		if self.direct:
+			try:
+				return os.open(self.filename, flags | os.O_DIRECT, 0o666)
+			except OSError as e:
+				if e.errno != errno.EINVAL:
+					raise
+				# filesystem without O_DIRECT support (vfat on some kernels)
+				self.direct = False
+		return os.open(self.filename, flags, 0o666)
+
+	def drop_cache(self, fd):
+		# without O_DIRECT the next read must not be served from page cache
+		if not self.direct:
+			os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
+	def write(self):
+		fd = self.open(os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+		try:
+			start = time.perf_counter()
+			for offset in range(0, self.size, self.block):
+				os.write(fd, self.wbuf)
+			os.fsync(fd)
+			elapsed = time.perf_counter() - start
+			self.drop_cache(fd)
+		except OSError as e:
+			if e.errno != errno.EINVAL or not self.direct:
+				raise
+			# O_DIRECT accepted by open() but refused by write()
+			self.direct = False
+			return self.write()
+		finally:
+			os.close(fd)
+		self.write_mbps = self.size / elapsed / 1000000.0
+
+	def read(self):
+		fd = self.open(os.O_RDONLY)
+		try:
+			self.verified = True
+			start = time.perf_counter()
+			for offset in range(0, self.size, self.block):
+				if os.readv(fd, [self.rbuf]) != self.block or self.rbuf[:] != self.pattern:
+					self.verified = False
+			elapsed = time.perf_counter() - start
+		finally:
+			os.close(fd)
+		self.read_mbps = self.size / elapsed / 1000000.0
+
+	def random_read(self):
+		blocks = self.size // self.random_block
+		buf = memoryview(self.rbuf)[:self.random_block]
+		fd = self.open(os.O_RDONLY)
+		try:
+			self.drop_cache(fd)
+			self.latencies = []
+			start = time.perf_counter()
+			for i in range(self.random_reads):
+				t = time.perf_counter()
+				os.preadv(fd, [buf], random.randrange(blocks) * self.random_block)
+				self.latencies.append(time.perf_counter() - t)
+			elapsed = time.perf_counter() - start
+		finally:
+			buf.release()
+			os.close(fd)
+		self.iops = self.random_reads / elapsed
+
+	def percentile(self, q):
+		l = sorted(self.latencies)
+		return l[min(len(l) - 1, int(q * len(l)))]
+
 ###############################################################################
 #	class Test_usb
 ###############################################################################
@@ -16,53 +120,119 @@ class Test_usb(Test_basic):
 		self.err_dict['CHECK_B_FAILED'] = 'Check pen drive B failed or invalid pen drive B'
 		self.err_dict['MOUNT_A_FAILED'] = 'Mount pen drive A failed'
 		self.err_dict['MOUNT_B_FAILED'] = 'Mount pen drive B failed'
+		self.err_dict['BENCH_FAILED'] = 'Benchmark on pen drive %s failed'
+		self.err_dict['BENCH_SLOW'] = 'Pen drive %s below speed threshold'
+		self.path_a = None
+		self.path_b = None
 	
 	def initialize(self):
 		Test_basic.initialize(self)
 
 	def finalize(self):
-		try:
-			Test_basic.finalize(self)
-		except Test_error as e:		
-			sys.exit(-1)
+		Test_basic.finalize(self)
+
+	def find_mount(self, label):
+		ret = subprocess.run(['findmnt', '-S', 'LABEL=\"%s\"' % label, '-n', '-o', 'TARGET'], stdout=subprocess.PIPE)
+		return ret.stdout.decode('utf-8')[:-1]
+
+	def verify(path):
+		return Sha256_verifier().verify(path, 'test-file.sha256')
+
+	def report(self, drive, result):
+		self.info('drive_%s_bytes' % drive, result.nbytes)
+		self.info('drive_%s_MBps' % drive, '{:0.1f}'.format(result.mbps()))
+		for name in result.failed:
+			self.warning('Checksum mismatch \'%s\' on drive %s' % (name, drive.upper()))
 
 	def check(self):
 		self.message('Check USB key A')
-		ret = subprocess.run(['findmnt', '-S', 'LABEL=\"%s\"' % self.label_a, '-n', '-o', 'TARGET'], stdout=subprocess.PIPE)
-		path_a = ret.stdout.decode('utf-8')[:-1]
+		path_a = self.find_mount(self.label_a)
 		if not os.path.exists(path_a):
 			raise Test_error(self, 'MOUNT_A_FAILED')
-		if subprocess.run(['sha256sum', '-c', 'test-file.sha256'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=path_a).returncode != 0:
-			raise Test_error(self, 'CHECK_A_FAILED')
+		self.path_a = path_a
 
 		self.message('Check USB key B')
-		ret = subprocess.run(['findmnt', '-S', 'LABEL=\"%s\"' % self.label_b, '-n', '-o', 'TARGET'], stdout=subprocess.PIPE)
-		path_b = ret.stdout.decode('utf-8')[:-1]
+		path_b = self.find_mount(self.label_b)
 		if not os.path.exists(path_b):
+			# drive A is still checked first, as before
+			result_a = Test_usb.verify(path_a)
+			self.report('a', result_a)
+			if not result_a.ok():
+				raise Test_error(self, 'CHECK_A_FAILED')
 			raise Test_error(self, 'MOUNT_B_FAILED')
-		if subprocess.run(['sha256sum', '-c', 'test-file.sha256'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=path_b).returncode != 0:
+		self.path_b = path_b
+
+		# hashlib releases the GIL, the two drives are read in parallel
+		with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+			result_a, result_b = executor.map(Test_usb.verify, [path_a, path_b])
+
+		self.report('a', result_a)
+		self.report('b', result_b)
+		if not result_a.ok():
+			raise Test_error(self, 'CHECK_A_FAILED')
+		if not result_b.ok():
 			raise Test_error(self, 'CHECK_B_FAILED')
 
+	def bench(self, drive, path):
+		c = self.config['usb']
+		b = Disk_benchmark(path, c['bench_size_kb'] * 1024, c['bench_block_kb'] * 1024, c['bench_random_kb'] * 1024, c['bench_random_reads'])
+		try:
+			b.write()
+			b.read()
+			b.random_read()
+		except OSError as e:
+			self.warning('Benchmark pen drive %s: %s' % (drive.upper(), e))
+			raise Test_error(self, 'BENCH_FAILED', drive.upper())
+		finally:
+			b.close()
+		self.info('drive_%s_direct' % drive, 'yes' if b.direct else 'no')
+		self.info('drive_%s_write_MBps' % drive, '{:0.1f}'.format(b.write_mbps))
+		self.info('drive_%s_read_MBps' % drive, '{:0.1f}'.format(b.read_mbps))
+		self.info('drive_%s_iops' % drive, '{:0.0f}'.format(b.iops))
+		for q in [50, 95, 99]:
+			self.info('drive_%s_lat_p%d_ms' % (drive, q), '{:0.3f}'.format(b.percentile(q / 100.0) * 1000.0))
+		if not b.verified:
+			raise Test_error(self, 'BENCH_FAILED', drive.upper())
+		if b.write_mbps < c['bench_min_write_MBps'] or b.read_mbps < c['bench_min_read_MBps'] or b.iops < c['bench_min_iops']:
+			raise Test_error(self, 'BENCH_SLOW', drive.upper())
+
 ###############################################################################
-try:
-	t = Test_usb()
-	
-	parser = argparse.ArgumentParser(description='Test USB')
-	t.add_common_arguments(parser)
-	parser.add_argument('--labela', type=str, default=t.config['usb']['labela'], help="set pen drive A label")
-	parser.add_argument('--labelb', type=str, default=t.config['usb']['labelb'], help="set pen drive B label")
-	args = parser.parse_args()
-	t.copy_common_arguments(args)
-	t.label_a = args.labela
-	t.label_b = args.labelb
+def run(argv=None):
+	t = None
+	try:
+		t = Test_usb()
+
+		parser = argparse.ArgumentParser(description='Test USB')
+		t.add_common_arguments(parser)
+		parser.add_argument('--labela', type=str, default=t.config['usb']['labela'], help="set pen drive A label")
+		parser.add_argument('--labelb', type=str, default=t.config['usb']['labelb'], help="set pen drive B label")
+		parser.add_argument('--bench', type=str, choices=['yes', 'no'], default=t.config['usb']['bench'], help="run the read/write bandwidth benchmark")
+		args = parser.parse_args(argv)
+		t.copy_common_arguments(args)
+		t.label_a = args.labela
+		t.label_b = args.labelb
 
-	t.initialize()
+		t.initialize()
 
-	t.check()
+		with t.phase('check'):
+			t.check()
 
-	t.success()
+		if args.bench == 'yes':
+			t.message('Benchmark USB key A')
+			with t.phase('bench_a'):
+				t.bench('a', t.path_a)
+			t.message('Benchmark USB key B')
+			with t.phase('bench_b'):
+				t.bench('b', t.path_b)
 
-except Test_error as e:
-	e.test.error(e.code, e.value)
+		return t.success()
 
+	except Test_error as e:
+		return e.test.error(e.code, e.value)
+	except Test_timeout:
+		if t == None:
+			raise
+		return t.timeout()
 
+if __name__ == '__main__':
+	sys.exit(run())
@@ -0,0 +1,115 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import json
+import socket
+import argparse
+import importlib
+import traceback
+import socketserver
+from common import *
+
+###############################################################################
+#	class Test_handler
+###############################################################################
+class Test_handler(socketserver.StreamRequestHandler):
+	def handle(self):
+		for line in self.rfile:
+			try:
+				request = json.loads(line.decode('utf-8'))
+				reply = self.server.run_test(request['test'], request.get('args', []))
+			except (ValueError, KeyError, TypeError) as e:
+				reply = { 'error': 'invalid request: %s' % e }
+			self.wfile.write((json.dumps(reply) + '\n').encode('utf-8'))
+			self.wfile.flush()
+
+###############################################################################
+#	class Test_server
+###############################################################################
+class Test_server(socketserver.UnixStreamServer):
+	# one request at a time, tests share hardware and stdout
+	def __init__(self, path):
+		if os.path.exists(path):
+			os.unlink(path)
+		socketserver.UnixStreamServer.__init__(self, path, Test_handler)
+		self.path = path
+		self.modules = dict()
+
+	def load_test(self, name):
+		if name not in self.modules:
+			self.modules[name] = importlib.import_module('test_%s' % name)
+		return self.modules[name]
+
+	def run_test(self, name, args):
+		if name not in Test_server.tests():
+			return { 'error': 'unknown test %s' % name }
+		Test_basic.last_result = None
+		try:
+			ret = self.load_test(name).run([str(a) for a in args])
+		except SystemExit as e:
+			# argparse errors and --help
+			ret = e.code if isinstance(e.code, int) else -1
+		except Exception:
+			Log_writer.get().flush()
+			traceback.print_exc()
+			ret = -1
+		finally:
+			Log_writer.get().flush()
+		return { 'test': name, 'returncode': ret, 'result': Test_basic.last_result }
+
+	@staticmethod
+	def tests():
+		return [f[5:-3] for f in os.listdir('.') if f.startswith('test_') and f.endswith('.py')]
+
+	def server_close(self):
+		socketserver.UnixStreamServer.server_close(self)
+		if os.path.exists(self.path):
+			os.unlink(self.path)
+
+###############################################################################
+#	request
+###############################################################################
+def request(path, test, args):
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	sock.connect(path)
+	f = sock.makefile('rwb')
+	f.write((json.dumps({ 'test': test, 'args': args }) + '\n').encode('utf-8'))
+	f.flush()
+	reply = json.loads(f.readline().decode('utf-8'))
+	sock.close()
+	return reply
+
+###############################################################################
+parser = argparse.ArgumentParser(description='Keep the test modules loaded and run tests on request', epilog='requests are JSON lines {"test": NAME, "args": [...]} on the unix socket')
+parser.add_argument('-s', '--socket', type=str, default=None, help="set unix socket path (default: daemon.socket in config.json)")
+parser.add_argument('-r', '--request', type=str, default=None, help="send a request for test REQUEST to a running daemon")
+parser.add_argument('args', nargs=argparse.REMAINDER, help="test arguments")
+args = parser.parse_args()
+
+if args.socket == None:
+	args.socket = load_cached('config.json', load_json_precompiled)['daemon']['socket']
+
+if args.request != None:
+	test_args = args.args
+	if len(test_args) > 0 and test_args[0] == '--':
+		test_args = test_args[1:]
+	reply = request(args.socket, args.request, test_args)
+	print(json.dumps(reply, indent=1))
+	sys.exit(0 if reply.get('returncode') == 0 else 1)
+
+if os.geteuid() != 0:
+	print('testd.py: must be run as root')
+	sys.exit(1)
+
+# keep CAN sockets and the stopped application between requests
+import test_can
+test_can.Can_port.keep_open = True
+
+server = Test_server(args.socket)
+try:
+	server.serve_forever()
+except KeyboardInterrupt:
+	pass
+finally:
+	server.server_close()